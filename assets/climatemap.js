@@ -0,0 +1,153 @@
+// draws the map from the map-coords store, which has the coordinates of
+// every row of the dataset and is only sent once per dataset version, and
+// the map-points store, which has which rows to show (a bitmask, eight rows
+// to a byte, lowest bit first, in base64) and their colors. see map_coordinates
+// and update_map in index.py. arrays come either as JSON lists or, from
+// typedarrays.py, as {dtype, bdata}, their little-endian bytes in base64.
+
+var TYPED_ARRAYS = {
+  uint8: Uint8Array,
+  int32: Int32Array,
+  float32: Float32Array,
+  float64: Float64Array,
+};
+
+function decodeArray(encoded) {
+  if (encoded === null || typeof encoded !== "object" || !encoded.bdata) {
+    return encoded;
+  }
+  var bytes = atob(encoded.bdata);
+  var buffer = new Uint8Array(bytes.length);
+  for (var i = 0; i < bytes.length; i++) {
+    buffer[i] = bytes.charCodeAt(i);
+  }
+  return new TYPED_ARRAYS[encoded.dtype](buffer.buffer);
+}
+
+// the last map-coords decoded, so that's only done once per version
+var decoded = { coords: null, lat: null, lon: null };
+
+// plotly's defaults for a geo_scope="usa" map that hasn't been moved
+var DEFAULT_VIEW = { scale: 1, lon: -96.6, lat: 38.7 };
+
+// the geo.projection.scale and geo.center the map is showing now, which
+// plotly keeps in the graph's layout as it's panned and zoomed.
+function currentView() {
+  var graph = document.querySelector("#climatemap .js-plotly-plot");
+  var geo = (graph && graph.layout && graph.layout.geo) || {};
+  var center = geo.center || {};
+  var projection = geo.projection || {};
+  return {
+    scale: projection.scale || DEFAULT_VIEW.scale,
+    lon: center.lon !== undefined ? center.lon : DEFAULT_VIEW.lon,
+    lat: center.lat !== undefined ? center.lat : DEFAULT_VIEW.lat,
+  };
+}
+
+// results with too many points for markers come as an image of the view,
+// rendered by map_tile in index.py in the map's albers usa projection. it's
+// laid over the whole plot area with sizing "contain", which plotly also
+// fits the map's frame into, so the two line up. the one trace is only
+// there for its colorbar.
+function drawRaster(points, coords) {
+  var base = coords.figure.data[0];
+  var trace = Object.assign({}, base, {
+    lat: [DEFAULT_VIEW.lat, DEFAULT_VIEW.lat],
+    lon: [DEFAULT_VIEW.lon, DEFAULT_VIEW.lon],
+    hoverinfo: "skip",
+    marker: Object.assign({}, base.marker, {
+      color: [points.cmin, points.cmax],
+      cmin: points.cmin,
+      cmax: points.cmax,
+      opacity: 0,
+    }),
+  });
+  var view = currentView();
+  var url = points.raster.url
+    .replace("{scale}", String(view.scale))
+    .replace("{lon}", String(view.lon))
+    .replace("{lat}", String(view.lat));
+  var layout = Object.assign({}, coords.figure.layout, {
+    images: [
+      {
+        source: url,
+        xref: "paper",
+        yref: "paper",
+        x: 0.5,
+        y: 0.5,
+        sizex: 1,
+        sizey: 1,
+        xanchor: "center",
+        yanchor: "middle",
+        sizing: "contain",
+        layer: "above",
+      },
+    ],
+  });
+  return { data: [trace], layout: layout };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+  climatemap: {
+    draw: function (points, coords) {
+      if (
+        !points ||
+        !coords ||
+        points.dataset !== coords.dataset ||
+        points.version !== coords.version
+      ) {
+        // the other store is still on its way
+        return window.dash_clientside.no_update;
+      }
+
+      if (points.raster) {
+        return drawRaster(points, coords);
+      }
+
+      if (decoded.coords !== coords) {
+        decoded = {
+          coords: coords,
+          lat: decodeArray(coords.lat),
+          lon: decodeArray(coords.lon),
+        };
+      }
+      var allLat = decoded.lat;
+      var allLon = decoded.lon;
+      var lat = [];
+      var lon = [];
+      if (points.mask !== null) {
+        var mask = atob(points.mask);
+        for (var i = 0; i < allLat.length; i++) {
+          if ((mask.charCodeAt(i >> 3) >> (i & 7)) & 1) {
+            lat.push(allLat[i]);
+            lon.push(allLon[i]);
+          }
+        }
+      }
+
+      var colors = decodeArray(points.colors);
+      var text = colors;
+      if (colors instanceof Float32Array) {
+        // hover text at the precision the colors were sent at, rather
+        // than the float32's exact decimal value
+        text = Array.from(colors, function (value) {
+          return Number(value.toPrecision(7));
+        });
+      }
+
+      var base = coords.figure.data[0];
+      var marker = Object.assign({}, base.marker, { color: colors });
+      if (points.cmin !== null) {
+        marker.cmin = points.cmin;
+        marker.cmax = points.cmax;
+      }
+      var trace = Object.assign({}, base, {
+        lat: lat,
+        lon: lon,
+        marker: marker,
+        text: text,
+      });
+      return { data: [trace], layout: coords.figure.layout };
+    },
+  },
+});
@@ -0,0 +1,64 @@
+// copies the map-pending store, which draw_ui in index.py writes whenever
+// the map's dataset, selection or filter changes, to the map-query store,
+// which the map is drawn from. changes made by typing only go through once
+// there's been no more typing for the typing-interval's interval, so that
+// half-typed expressions aren't evaluated. each query gets this page's
+// client id and a sequence number, so the server can drop any it's still
+// working on once a newer one comes in.
+
+var typing = {
+  client: Math.random().toString(36).slice(2) + Date.now().toString(36),
+  seq: 0,
+  lastEdit: 0,
+};
+
+function sameQuery(a, b) {
+  return (
+    !!a &&
+    !!b &&
+    a.dataset === b.dataset &&
+    a.version === b.version &&
+    a.selection === b.selection &&
+    a.filter === b.filter
+  );
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+  debounce: {
+    settle: function (pending, n_intervals, current, interval) {
+      var no_update = window.dash_clientside.no_update;
+      if (!pending) {
+        return [no_update, true];
+      }
+      var triggered = window.dash_clientside.callback_context.triggered.map(
+        function (trigger) {
+          return trigger.prop_id;
+        }
+      );
+      var now = Date.now();
+      if (triggered.indexOf("map-pending.data") >= 0) {
+        if (pending.typed) {
+          // wait for the typing to stop
+          typing.lastEdit = now;
+          return [no_update, false];
+        }
+      } else if (now - typing.lastEdit < interval) {
+        return [no_update, false];
+      }
+
+      if (sameQuery(pending, current)) {
+        return [no_update, true];
+      }
+      typing.seq += 1;
+      var query = {
+        dataset: pending.dataset,
+        version: pending.version,
+        selection: pending.selection,
+        filter: pending.filter,
+        client: typing.client,
+        seq: typing.seq,
+      };
+      return [query, true];
+    },
+  },
+});
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import os, sys, numpy
+import argparse, os, sys, numpy
 
 from netCDF4 import Dataset
 
@@ -11,10 +11,7 @@ timeframes = [
 ]
 timeframe_names = ["2010", "2050", "2090"]
 timedelta_names = ["2050d", "2090d"]
-grid = "NAM-22i"
-scenario = "rcp85"
 granularity = "day"
-bias = "mbcn-gridMET"
 root = "./data"
 
 models = {
@@ -55,6 +52,16 @@ models = {
 }
 
 
+# the dashboard serves data.tsv as the default dataset, and any
+# data.<grid>.<scenario>.<bias>.tsv next to it as the others.
+parser = argparse.ArgumentParser(description="write an ensemble mean tsv to stdout")
+parser.add_argument("--grid", default="NAM-22i", choices=sorted(models))
+parser.add_argument("--scenario", default="rcp85")
+parser.add_argument("--bias", default="mbcn-gridMET")
+args = parser.parse_args()
+grid, scenario, bias = args.grid, args.scenario, args.bias
+
+
 def stull_wetbulb(temp_c, relhum_pc):
     # https://open.library.ubc.ca/media/stream/pdf/52383/1.0041967/1
     # example from paper: stull_wetbulb(20, 50) should be 13.7
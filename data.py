@@ -1,13 +1,36 @@
 #!/usr/bin/env python3
 
-import pandas as pd
+import collections.abc
+import glob
+import logging
+import os
+import tempfile
+import threading
+import time
+import weakref
 import numpy as np
 
 
-import uel
+import uel, uel_numpy, datacache
 
+log = logging.getLogger(__name__)
 
-df = pd.read_csv("data.tsv", sep="\t")
+# set CLIMATEDASH_DTYPE=float32 to store the climate columns at half the
+# memory. fips, lat and lon are always stored as parsed. a matching cache is
+# built with "python datacache.py data.tsv --dtype float32".
+STORAGE_DTYPE = os.environ.get("CLIMATEDASH_DTYPE") or None
+
+# how often, in seconds, to check whether data.tsv has changed and reload it
+# in the background. set CLIMATEDASH_RELOAD_SECONDS=0 to never reload.
+RELOAD_INTERVAL = float(os.environ.get("CLIMATEDASH_RELOAD_SECONDS", "30"))
+
+# datasets are keyed by (grid, scenario, bias). data.tsv is this one, and
+# any data.<grid>.<scenario>.<bias>.tsv (see data-gen/generate-tsv.py) is
+# served as well. set CLIMATEDASH_DATASETS_MB to cap how much memory the
+# loaded datasets take together; the least recently used are unloaded.
+DEFAULT_DATASET = ("NAM-22i", "rcp85", "mbcn-gridMET")
+DATASETS_BUDGET = os.environ.get("CLIMATEDASH_DATASETS_MB")
+DATASETS_BUDGET = DATASETS_BUDGET and int(float(DATASETS_BUDGET) * 2**20)
 
 timeChooserNames = {
     "2010 value": "2010",
@@ -44,12 +67,13 @@ valueChooserVals = {v: k for k, v in valueChooserNames.items()}
 
 presentValuesOnly = set(["elevation", "fips"])
 
+# (scale, offset), for converted = raw * scale + offset
 unitConversions = {
-    "mm/day->in/year": lambda x: (x / 25.4) * 365.25,
-    "m->ft": lambda x: x * 3.28084,
-    "C->F": lambda x: x * 9 / 5 + 32,
-    "dC->dF": lambda x: x * 9 / 5,
-    "m/s->mph": lambda x: x * 2.23694,
+    "mm/day->in/year": (365.25 / 25.4, 0),
+    "m->ft": (3.28084, 0),
+    "C->F": (9 / 5, 32),
+    "dC->dF": (9 / 5, 0),
+    "m/s->mph": (2.23694, 0),
 }
 
 varnameConversions = {}
@@ -77,6 +101,18 @@ unitDisplays = {
 
 comparators = ["<", "<=", "==", ">=", ">", "!="]
 
+# sorted indexes let filters like tmax_avg_max_2050 > 95 find their rows
+# with a binary search instead of a scan, at the cost of about three times
+# the memory of each column. set CLIMATEDASH_INDEXES=0 to skip them.
+BUILD_INDEXES = os.environ.get("CLIMATEDASH_INDEXES", "1") != "0"
+
+# converted columns and indexes are built the first time a query uses them.
+# set CLIMATEDASH_ENV_BUDGET_MB to cap the memory a dataset's env and
+# indexes each keep them in; the least recently used are dropped and rebuilt
+# on demand.
+ENV_BUDGET = os.environ.get("CLIMATEDASH_ENV_BUDGET_MB")
+ENV_BUDGET = ENV_BUDGET and int(float(ENV_BUDGET) * 2**20)
+
 
 def varname(valname, timename):
     v = valueChooserNames[valname]
@@ -85,43 +121,629 @@ def varname(valname, timename):
     return v + "_" + timeChooserNames[timename]
 
 
-UEL_ENV = {
-    uel.OpOr: np.logical_or,
-    uel.OpAnd: np.logical_and,
-    uel.ModNot: np.logical_not,
-    "true": True,
-    "false": False,
-}
+class LazyEnv(collections.abc.Mapping):
+    """
+    a read-only mapping for uel environments whose values are built by a
+    factory the first time they're looked up, and kept after that. fixed
+    entries like the logical ops are stored as given. with a budget in
+    bytes, the least recently used built values are dropped once their
+    total size goes over it. "in" only checks the keys, so it never builds
+    anything. on_build, if given, is called after each value is built.
+    """
 
-UEL_ENV_CHECK = {k: v for k, v in UEL_ENV.items()}
+    def __init__(self, fixed=None, budget=None, on_build=None):
+        self.fixed = dict(fixed or {})
+        self.factories = {}
+        self.built = collections.OrderedDict()
+        self.budget = budget
+        self.on_build = on_build
+        self.nbytes = 0
+        self.builds = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
 
+    def define(self, key, factory):
+        self.factories[key] = factory
 
-def set_in_env(var, time_suffix):
-    if time_suffix is None:
-        varname = var
-    else:
-        varname = "%s_%s" % (var, time_suffix)
-    display_conversion = unitDisplays.get(var, None)
-    if display_conversion is None:
-        UEL_ENV[varname] = df[varnameConversions.get(varname, varname)]
-    else:
-        if (
+    def __contains__(self, key):
+        return key in self.fixed or key in self.factories
+
+    def __getitem__(self, key):
+        if key in self.fixed:
+            return self.fixed[key]
+        with self.lock:
+            if key in self.built:
+                self.built.move_to_end(key)
+                return self.built[key]
+        # built outside the lock, so a slow conversion doesn't hold up
+        # lookups of other keys. two threads may both build the same key.
+        value = self.factories[key]()
+        with self.lock:
+            if key not in self.built:
+                self.built[key] = value
+                self.nbytes += getattr(value, "nbytes", 0)
+                self.builds += 1
+                while self.budget and self.nbytes > self.budget and len(self.built) > 1:
+                    _, dropped = self.built.popitem(last=False)
+                    self.nbytes -= getattr(dropped, "nbytes", 0)
+                    self.evictions += 1
+            value = self.built.get(key, value)
+        if self.on_build is not None:
+            self.on_build()
+        return value
+
+    def __iter__(self):
+        yield from self.fixed
+        yield from self.factories
+
+    def __len__(self):
+        return len(self.fixed) + len(self.factories)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "defined": len(self.factories),
+                "built": len(self.built),
+                "nbytes": self.nbytes,
+                "builds": self.builds,
+                "evictions": self.evictions,
+            }
+
+
+class GridIndex:
+    """
+    a uniform grid of cell_size degree cells over a dataset's lat/lon, with
+    the rows sorted by the cell they fall in. the rows in a bounding box are
+    then one contiguous run of that order per row of cells the box covers,
+    and only the runs' edge cells need their coordinates checked.
+    """
+
+    def __init__(self, lat, lon, cell_size=1.0):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.cell_size = cell_size
+        located = ~(np.isnan(self.lat) | np.isnan(self.lon))
+        if not located.any():
+            self.lat0 = self.lon0 = 0.0
+            self.shape = (0, 0)
+            self.order = np.zeros(0, dtype=np.intp)
+            self.starts = np.zeros(1, dtype=np.intp)
+            return
+        self.lat0 = self.lat[located].min()
+        self.lon0 = self.lon[located].min()
+        self.shape = (
+            int((self.lat[located].max() - self.lat0) // cell_size) + 1,
+            int((self.lon[located].max() - self.lon0) // cell_size) + 1,
+        )
+        rows = np.flatnonzero(located)
+        cells = self.cells(self.lat[rows], self.lon[rows])
+        order = np.argsort(cells, kind="stable")
+        self.order = rows[order]
+        self.starts = np.searchsorted(
+            cells[order], np.arange(self.shape[0] * self.shape[1] + 1)
+        )
+
+    def cells(self, lat, lon):
+        i = ((lat - self.lat0) // self.cell_size).astype(np.intp)
+        j = ((lon - self.lon0) // self.cell_size).astype(np.intp)
+        return i * self.shape[1] + j
+
+    def query(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        returns the sorted indexes of the rows within the bounding box.
+        """
+        size, (height, width) = self.cell_size, self.shape
+        i0 = max(0, int((lat_min - self.lat0) // size))
+        i1 = min(height - 1, int((lat_max - self.lat0) // size))
+        j0 = max(0, int((lon_min - self.lon0) // size))
+        j1 = min(width - 1, int((lon_max - self.lon0) // size))
+        if i0 > i1 or j0 > j1:
+            return np.zeros(0, dtype=np.intp)
+        rows = np.concatenate(
+            [
+                self.order[
+                    self.starts[i * width + j0] : self.starts[i * width + j1 + 1]
+                ]
+                for i in range(i0, i1 + 1)
+            ]
+        )
+        lat, lon = self.lat[rows], self.lon[rows]
+        rows = rows[
+            (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        ]
+        rows.sort()
+        return rows
+
+
+def source_version(tsv_path):
+    """
+    identifies the current contents of a tsv, the same way in every process.
+    """
+    stamp = datacache.source_stamp(tsv_path)
+    return "%x-%x" % (stamp["mtime_ns"], stamp["size"])
+
+
+class Dataset:
+    """
+    one version of a data tsv, loaded: its columns (df), and the uel
+    environment (env), indexes, symbols and affine conversions built from
+    them. a Dataset isn't changed after it's built. reloading builds a new
+    one, and anything cached from a Dataset's values should be keyed by its
+    version. on_build is called whenever env or indexes builds something.
+    """
+
+    def __init__(self, tsv_path, version, on_build=None):
+        self.tsv_path = tsv_path
+        self.version = version
+        started = time.perf_counter()
+
+        # a dict of column name to Series, memory-mapped from the cache
+        # directory if "python datacache.py" has been run since the tsv last
+        # changed.
+        self.df, storage_errors, column_stats = datacache.load(
+            tsv_path, dtype=STORAGE_DTYPE
+        )
+        parsed = time.perf_counter()
+        for name, error in sorted(storage_errors.items()):
+            log.info(
+                "%s stored as %s: max abs error %.3g, max rel error %.3g",
+                name,
+                STORAGE_DTYPE,
+                error["max_abs"],
+                error["max_rel"],
+            )
+
+        self.spatial = GridIndex(self.df["lat"], self.df["lon"])
+
+        self.env = LazyEnv(
+            {
+                uel.OpOr: np.logical_or,
+                uel.OpAnd: np.logical_and,
+                uel.ModNot: np.logical_not,
+                "true": True,
+                "false": False,
+            },
+            budget=ENV_BUDGET,
+            on_build=on_build,
+        )
+        self.indexes = LazyEnv(budget=ENV_BUDGET, on_build=on_build)
+        # variables that are unit conversions of a raw column, as (name,
+        # scale, offset) for uel.optimize. raw columns are in env as
+        # "raw:<column>", which can't be typed into an expression.
+        self.affine = {}
+        self.symbols = {
+            "true": uel.Symbol(uel.BOOLEAN),
+            "false": uel.Symbol(uel.BOOLEAN),
+        }
+        # datastats.ColumnStats of each variable in env, from the ones
+        # computed along with the cache
+        self.stats = {}
+
+        for var in valueChooserNames.values():
+            if var in presentValuesOnly:
+                self.set_in_env(var, None, column_stats)
+            else:
+                for time_suffix in timeChooserNames.values():
+                    self.set_in_env(var, time_suffix, column_stats)
+
+        # seconds spent reading the columns, and building the spatial index
+        # and defining env's and indexes' entries. converted columns and
+        # sorted indexes are only built when they're first used, so their
+        # time isn't in either.
+        self.timings = {
+            "parse": parsed - started,
+            "setup": time.perf_counter() - parsed,
+        }
+
+    @property
+    def nbytes(self):
+        return (
+            sum(column.nbytes for column in self.df.values())
+            + self.env.nbytes
+            + self.indexes.nbytes
+        )
+
+    def set_in_env(self, var, time_suffix, column_stats):
+        if time_suffix is None:
+            varname = var
+        else:
+            varname = "%s_%s" % (var, time_suffix)
+        raw_name = varnameConversions.get(varname, varname)
+        column = self.df[raw_name]
+        stats = column_stats.get(raw_name)
+        display_conversion = unitDisplays.get(var, None)
+        if display_conversion is None:
+            conversion = None
+        elif (
             time_suffix in deltaNames
             and "d%s->d%s" % display_conversion in unitConversions
         ):
-            UEL_ENV[varname] = unitConversions["d%s->d%s" % display_conversion](
-                df[varnameConversions.get(varname, varname)]
-            )
+            conversion = unitConversions["d%s->d%s" % display_conversion]
+        else:
+            conversion = unitConversions["%s->%s" % display_conversion]
+
+        env = self.env
+        if conversion is None:
+            env.define(varname, lambda: column)
+            dtype = column.dtype
+            indexed = varname
+            if stats is not None:
+                self.stats[varname] = stats
+        else:
+            # expressions that went through uel.optimize with affine only
+            # ever look up the raw column. the converted one is for
+            # everything else.
+            scale, offset = conversion
+            raw_name = "raw:" + raw_name
+            self.affine[varname] = (raw_name, scale, offset)
+            env.define(raw_name, lambda: column)
+            env.define(varname, lambda: column * scale + offset)
+            dtype = (column[:1] * scale + offset).dtype
+            indexed = raw_name
+            if stats is not None:
+                self.stats[raw_name] = stats
+                self.stats[varname] = stats.converted(scale, offset)
+        if BUILD_INDEXES:
+            self.indexes.define(indexed, lambda: uel_numpy.SortedIndex(env[indexed]))
+        self.symbols[varname] = uel.Symbol(
+            uel.NUMBER,
+            dtype=dtype.name,
+            units=display_conversion and display_conversion[1],
+        )
+
+
+class DatasetSource:
+    """
+    keeps the current Dataset for a tsv. current() looks at the file at most
+    every reload_interval seconds, and when it has changed, builds a new
+    Dataset on a background thread and swaps it in once it's complete, so
+    requests never wait on a reload. callers should call current() once and
+    use that Dataset throughout, so they see a single version even if a
+    reload finishes meanwhile. replace the tsv with a rename rather than
+    rewriting it in place, or a reload can see it half written.
+
+    each process reloads on its own schedule, so a request can be for a
+    version another process has and this one doesn't. get(version) finds
+    it if it's the version a reload replaced, or one that's still in use,
+    and waits for it if it's what the tsv has changed to.
+
+    on_build is passed on to each Dataset, and also called after a reload.
+    """
+
+    def __init__(self, tsv_path, reload_interval=RELOAD_INTERVAL, on_build=None):
+        self.tsv_path = tsv_path
+        self.reload_interval = reload_interval
+        self.on_build = on_build
+        self.dataset = Dataset(tsv_path, source_version(tsv_path), on_build)
+        self.previous = None
+        self.versions = weakref.WeakValueDictionary(
+            {self.dataset.version: self.dataset}
+        )
+        self.checked = time.monotonic()
+        self.reloading = False
+        self.lock = threading.Lock()
+        self.reloaded = threading.Condition(self.lock)
+
+    @property
+    def nbytes(self):
+        return self.dataset.nbytes + (self.previous and self.previous.nbytes or 0)
+
+    def current(self):
+        if (
+            self.reload_interval > 0
+            and time.monotonic() - self.checked >= self.reload_interval
+        ):
+            self.check()
+        return self.dataset
+
+    def get(self, version):
+        """
+        returns the Dataset at version, or None if this source doesn't have
+        it and the tsv isn't at that version now.
+        """
+        dataset = self.versions.get(version)
+        if dataset is None:
+            self.check()
+            with self.lock:
+                self.reloaded.wait_for(lambda: not self.reloading)
+            dataset = self.versions.get(version)
+        return dataset
+
+    def check(self):
+        with self.lock:
+            self.checked = time.monotonic()
+            if self.reloading:
+                return
+            try:
+                version = source_version(self.tsv_path)
+            except OSError:
+                # most likely in the middle of being replaced
+                return
+            if version == self.dataset.version:
+                return
+            self.reloading = True
+        threading.Thread(target=self.reload, args=(version,), daemon=True).start()
+
+    def reload(self, version):
+        dataset = None
+        try:
+            log.info("reloading %s as version %s", self.tsv_path, version)
+            dataset = Dataset(self.tsv_path, version, self.on_build)
+        except Exception:
+            log.exception("reloading %s failed", self.tsv_path)
+        with self.lock:
+            if dataset is not None:
+                self.previous, self.dataset = self.dataset, dataset
+                self.versions[version] = dataset
+            self.reloading = False
+            self.reloaded.notify_all()
+        if dataset is not None and self.on_build is not None:
+            self.on_build()
+
+
+def dataset_name(key):
+    return ".".join(key)
+
+
+def dataset_key(name):
+    """
+    the key for a name from dataset_name, or None if it isn't one.
+    """
+    key = tuple((name or "").split("."))
+    return key if len(key) == 3 and all(key) else None
+
+
+def discover(directory="."):
+    """
+    returns a dict of dataset key to tsv path for the tsvs in directory.
+    """
+    paths = {}
+    for path in glob.glob(os.path.join(directory, "data.*.*.*.tsv")):
+        key = dataset_key(os.path.basename(path)[len("data.") : -len(".tsv")])
+        if key is not None:
+            paths[key] = path
+    if os.path.exists(os.path.join(directory, "data.tsv")):
+        paths[DEFAULT_DATASET] = os.path.join(directory, "data.tsv")
+    return paths
+
+
+class DatasetRegistry:
+    """
+    the datasets a deployment serves, as a DatasetSource per key. each is
+    loaded the first time it's asked for. with a budget in bytes, the least
+    recently used are unloaded once the loaded ones take more than that
+    together, and loaded again if they're asked for again. callbacks that
+    are still using an unloaded Dataset keep it alive until they're done.
+    """
+
+    def __init__(self, paths, default=DEFAULT_DATASET, budget=None):
+        self.paths = paths
+        self.default = default if default in paths else min(paths, default=default)
+        self.budget = budget
+        self.sources = collections.OrderedDict()
+        self.loading = {}
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def keys(self):
+        return sorted(self.paths)
+
+    def get(self, key=None, version=None):
+        """
+        returns the current Dataset for key, or for the default dataset if
+        key is None or unknown. with a version, that version is returned
+        instead if the DatasetSource can still get it.
+        """
+        source = self.source(key)
+        dataset = version is not None and source.get(version)
+        return dataset or source.current()
+
+    def source(self, key):
+        if key not in self.paths:
+            key = self.default
+        with self.lock:
+            source = self.sources.get(key)
+            if source is not None:
+                self.sources.move_to_end(key)
+                return source
+            loading = self.loading.setdefault(key, threading.Lock())
+        # only one thread loads a given dataset, and loading one doesn't
+        # hold up requests for the others.
+        with loading:
+            with self.lock:
+                source = self.sources.get(key)
+            if source is None:
+                log.info("loading dataset %s", dataset_name(key))
+                source = DatasetSource(self.paths[key], on_build=self.check_budget)
+                with self.lock:
+                    self.sources[key] = source
+                    self.loads += 1
+                    self.evict()
+        return source
+
+    def check_budget(self):
+        # datasets grow as their columns and indexes are built, not just
+        # when they're loaded
+        with self.lock:
+            self.evict()
+
+    def evict(self):
+        if not self.budget:
+            return
+        total = sum(source.nbytes for source in self.sources.values())
+        while total > self.budget and len(self.sources) > 1:
+            key, source = self.sources.popitem(last=False)
+            total -= source.nbytes
+            self.evictions += 1
+            log.info("unloading dataset %s", dataset_name(key))
+
+
+DATASETS = DatasetRegistry(discover(), budget=DATASETS_BUDGET)
+
+
+def write_test_tsv(path, rows, seed=0):
+    """
+    writes a tsv of rows random points with every column a Dataset reads,
+    for run_tests.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {
+        "fips": rng.integers(1000, 57000, rows).astype(float),
+        "lat": rng.uniform(25, 50, rows),
+        "lon": rng.uniform(-125, -65, rows),
+    }
+    for var in valueChooserNames.values():
+        if var in presentValuesOnly:
+            names = [var]
         else:
-            UEL_ENV[varname] = unitConversions["%s->%s" % display_conversion](
-                df[varnameConversions.get(varname, varname)]
+            names = [var + "_" + t for t in timeChooserNames.values()]
+        for name in names:
+            columns.setdefault(
+                varnameConversions.get(name, name), rng.normal(size=rows)
             )
-    UEL_ENV_CHECK[varname] = UEL_ENV[varname][:1]
+    with open(path + ".tmp", "w") as fh:
+        fh.write("\t".join(columns) + "\n")
+        for row in zip(*columns.values()):
+            fh.write("\t".join(repr(float(value)) for value in row) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def run_tests():
+    built = []
+
+    def factory(key):
+        def build():
+            built.append(key)
+            return np.zeros(10)
+
+        return build
+
+    env = LazyEnv({"true": True}, budget=200)
+    for key in "abc":
+        env.define(key, factory(key))
+    if "a" not in env or "true" not in env or built:
+        raise Exception("expected in to find keys without building them")
+    if (
+        env["true"] is not True
+        or len(env) != 4
+        or sorted(env) != ["a", "b", "c", "true"]
+    ):
+        raise Exception("expected fixed entries to be kept as given")
+    if env["a"] is not env["a"] or built != ["a"]:
+        raise Exception("expected a value to be built on first access and kept")
+    env["b"]
+    env["a"]
+    env["c"]
+    stats = env.stats()
+    if (
+        stats["nbytes"] != 160
+        or stats["evictions"] != 1
+        or list(env.built) != ["a", "c"]
+    ):
+        raise Exception("expected the least recently used value dropped, %r" % stats)
+    env["b"]
+    if built != ["a", "b", "c", "b"] or env.stats()["builds"] != 4:
+        raise Exception("expected a dropped value to be built again, got %r" % built)
+
+    rng = np.random.default_rng(0)
+    lat, lon = rng.uniform(25, 50, 5000), rng.uniform(-125, -65, 5000)
+    lat[::13] = np.nan
+    lon[::17] = np.nan
+    spatial = GridIndex(lat, lon, cell_size=0.7)
+    boxes = [(20, 60, -130, -60), (30, 30.5, -100, -99), (51, 52, -100, -90)]
+    for _ in range(200):
+        lat_min, lon_min = rng.uniform(20, 50), rng.uniform(-130, -65)
+        boxes.append(
+            (
+                lat_min,
+                lat_min + rng.uniform(0, 10),
+                lon_min,
+                lon_min + rng.uniform(0, 20),
+            )
+        )
+    for lat_min, lat_max, lon_min, lon_max in boxes:
+        expected = np.flatnonzero(
+            (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+        )
+        rows = spatial.query(lat_min, lat_max, lon_min, lon_max)
+        if not np.array_equal(rows, expected):
+            raise Exception(
+                "box %r gave different rows" % ((lat_min, lat_max, lon_min, lon_max),)
+            )
+    if len(GridIndex(lat * np.nan, lon).query(-90, 90, -180, 180)):
+        raise Exception("expected no rows from an index without coordinates")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "data.tsv")
+        write_test_tsv(path, 50)
+        source = DatasetSource(path, reload_interval=0)
+        old = source.current()
+        old_values = np.array(old.env["tmean_avg_2050"])
+        write_test_tsv(path, 60, seed=1)
+        source.check()
+        deadline = time.monotonic() + 30
+        while source.reloading and time.monotonic() < deadline:
+            time.sleep(0.01)
+        new = source.current()
+        if new is old or new.version != source_version(path):
+            raise Exception("expected the changed tsv to be swapped in")
+        if len(new.df["lat"]) != 60 or len(old.df["lat"]) != 50:
+            raise Exception("expected each version to keep its own rows")
+        if not np.array_equal(old.env["tmean_avg_2050"], old_values):
+            raise Exception("expected the old Dataset to be unchanged by the reload")
+        if old.env["tmax_avg_max_2090"].shape != (50,):
+            raise Exception("expected the old Dataset to still build its own columns")
+        if source.get(old.version) is not old or source.get("0-0") is not None:
+            raise Exception("expected the replaced version to still be served")
+        write_test_tsv(path, 70, seed=2)
+        newest = source.get(source_version(path))
+        if (
+            newest is None
+            or len(newest.df["lat"]) != 70
+            or source.current() is not newest
+        ):
+            raise Exception("expected a version the tsv has changed to to be loaded")
+        if source.get(new.version) is not new or source.get(old.version) is not old:
+            raise Exception("expected versions still in use to be served")
+        del old
+        if source.get(source_version(path)) is not newest or len(source.versions) != 2:
+            raise Exception("expected only the replaced version to be kept")
+
+        paths = {}
+        for i, key in enumerate([("a", "x", "y"), ("b", "x", "y"), ("c", "x", "y")]):
+            paths[key] = os.path.join(directory, "data.%s.tsv" % dataset_name(key))
+            write_test_tsv(paths[key], 40, seed=i)
+        if discover(directory) != {**paths, DEFAULT_DATASET: path}:
+            raise Exception("expected every data tsv to be discovered")
+        budget = Dataset(paths["a", "x", "y"], "test").nbytes * 3 // 2
+        registry = DatasetRegistry(paths, budget=budget)
+        first = registry.get(("a", "x", "y"))
+        if (
+            registry.get(None) is not first
+            or registry.get(("z", "z", "z")) is not first
+        ):
+            raise Exception("expected unknown keys to get the default dataset")
+        registry.get(("b", "x", "y"))
+        if list(registry.sources) != [("b", "x", "y")] or registry.evictions != 1:
+            raise Exception("expected the least recently used dataset unloaded")
+        if first.env["tmean_avg_2010"].shape != (40,):
+            raise Exception("expected an unloaded Dataset to stay usable")
+        registry.get(("a", "x", "y"))
+        if registry.loads != 3 or list(registry.sources) != [("a", "x", "y")]:
+            raise Exception("expected an unloaded dataset to be loaded again")
+
+        fresh = Dataset(paths["a", "x", "y"], "test").nbytes
+        registry = DatasetRegistry(paths, budget=fresh * 2 + fresh // 2)
+        registry.get(("a", "x", "y"))
+        grown = registry.get(("b", "x", "y"))
+        if registry.evictions != 0:
+            raise Exception("expected both datasets to fit when loaded")
+        for name in grown.symbols:
+            grown.env[name]
+        if list(registry.sources) != [("b", "x", "y")] or registry.evictions != 1:
+            raise Exception("expected building columns to unload other datasets")
 
 
-for var in valueChooserNames.values():
-    if var in presentValuesOnly:
-        set_in_env(var, None)
-    else:
-        for time_suffix in timeChooserNames.values():
-            set_in_env(var, time_suffix)
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+"""
+a columnar binary cache of a data tsv: one .npy file per column plus a
+manifest, next to the tsv (data.tsv -> data.cache/). loading memory-maps the
+columns instead of parsing text, so startup is nearly instant and every
+worker process shares the same pages through the OS page cache.
+
+build the cache with:
+
+    python datacache.py [data.tsv] [--dtype float32]
+
+and run its tests with "python datacache.py --test".
+
+with a dtype, float columns are stored at that precision, except for the
+ones in EXACT_COLUMNS, and the largest error that introduced in each column
+is recorded in the manifest. so are the datastats of each column.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import datastats
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 3
+
+# identifiers and coordinates, which are always stored as parsed
+EXACT_COLUMNS = ("fips", "lat", "lon")
+
+
+def cache_dir_for(tsv_path):
+    return os.path.splitext(tsv_path)[0] + ".cache"
+
+
+def source_stamp(tsv_path):
+    st = os.stat(tsv_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def storage_error(original, stored):
+    """
+    returns the largest absolute and relative difference between original
+    and stored, ignoring NaNs.
+    """
+    diff = np.abs(stored.astype(original.dtype) - original)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel = np.where(diff == 0, 0, diff / np.abs(original))
+    return {
+        "max_abs": float(np.fmax.reduce(diff, initial=0.0)),
+        "max_rel": float(np.fmax.reduce(rel, initial=0.0)),
+    }
+
+
+def storage_columns(frame, dtype=None):
+    """
+    returns the columns of frame as arrays, with the float ones outside
+    EXACT_COLUMNS cast to dtype, and the storage_error of each cast column.
+    """
+    columns, errors = {}, {}
+    for name in frame.columns:
+        values = frame[name].values
+        if (
+            dtype is not None
+            and values.dtype.kind == "f"
+            and values.dtype != dtype
+            and name not in EXACT_COLUMNS
+        ):
+            stored = values.astype(dtype)
+            errors[name] = storage_error(values, stored)
+            values = stored
+        columns[name] = values
+    return columns, errors
+
+
+def build(tsv_path, cache_dir=None, dtype=None):
+    if cache_dir is None:
+        cache_dir = cache_dir_for(tsv_path)
+    stamp = source_stamp(tsv_path)
+    frame = pd.read_csv(tsv_path, sep="\t")
+    arrays, errors = storage_columns(frame, dtype)
+    stats = datastats.compute(arrays)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    columns = []
+    for i, (name, values) in enumerate(arrays.items()):
+        filename = "%04d.npy" % i
+        # written aside and renamed into place, so processes that have the
+        # old file memory-mapped keep their copy
+        path = os.path.join(cache_dir, filename)
+        with open(path + ".tmp", "wb") as fh:
+            np.save(fh, np.ascontiguousarray(values))
+        os.replace(path + ".tmp", path)
+        column = {"name": name, "file": filename}
+        if name in errors:
+            column["error"] = errors[name]
+        if name in stats:
+            column["stats"] = stats[name].to_json()
+        columns.append(column)
+
+    # the manifest goes last, so a half-built cache never looks valid
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    with open(manifest_path + ".tmp", "w") as fh:
+        json.dump(
+            {
+                "version": FORMAT_VERSION,
+                "source": stamp,
+                "dtype": dtype and np.dtype(dtype).name,
+                "rows": len(frame),
+                "columns": columns,
+            },
+            fh,
+            indent=2,
+        )
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def read_manifest(tsv_path, cache_dir, dtype=None):
+    """
+    returns the cache's manifest, or None if the cache is missing, from an
+    older format, stored at a different dtype, or was built from a
+    different version of the tsv.
+    """
+    try:
+        with open(os.path.join(cache_dir, MANIFEST)) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != FORMAT_VERSION:
+        return None
+    if manifest.get("dtype") != (dtype and np.dtype(dtype).name):
+        return None
+    if os.path.exists(tsv_path) and manifest.get("source") != source_stamp(tsv_path):
+        return None
+    return manifest
+
+
+def load(tsv_path, cache_dir=None, dtype=None):
+    """
+    returns a dict of column name to pandas Series, memory-mapped from the
+    cache if it's up to date, and otherwise parsed from the tsv, along with
+    the storage_error of each column that was stored as dtype, and the
+    datastats.ColumnStats of each numeric column.
+    """
+    if cache_dir is None:
+        cache_dir = cache_dir_for(tsv_path)
+    manifest = read_manifest(tsv_path, cache_dir, dtype)
+    if manifest is None:
+        arrays, errors = storage_columns(pd.read_csv(tsv_path, sep="\t"), dtype)
+        columns = {
+            name: pd.Series(values, name=name, copy=False)
+            for name, values in arrays.items()
+        }
+        return columns, errors, datastats.compute(arrays)
+
+    columns, errors, stats = {}, {}, {}
+    for column in manifest["columns"]:
+        values = np.load(os.path.join(cache_dir, column["file"]), mmap_mode="r")
+        columns[column["name"]] = pd.Series(
+            values.view(np.ndarray), name=column["name"], copy=False
+        )
+        if "error" in column:
+            errors[column["name"]] = column["error"]
+        if "stats" in column:
+            stats[column["name"]] = datastats.ColumnStats.from_json(column["stats"])
+    return columns, errors, stats
+
+
+def run_tests():
+    def write_tsv(path, rows, seed):
+        rng = np.random.default_rng(seed)
+        frame = pd.DataFrame(
+            {
+                "fips": rng.integers(1000, 57000, rows).astype(float),
+                "lat": rng.uniform(25, 50, rows),
+                "lon": rng.uniform(-125, -65, rows),
+                "tmean_avg_2050": rng.normal(15, 10, rows),
+                "count": rng.integers(0, 100, rows),
+            }
+        )
+        frame.loc[::7, "tmean_avg_2050"] = np.nan
+        frame.to_csv(path, sep="\t", index=False)
+        return pd.read_csv(path, sep="\t")
+
+    def same(loaded, expected):
+        return list(loaded) == list(expected.columns) and all(
+            loaded[name].dtype == expected[name].dtype
+            and np.array_equal(
+                loaded[name].values, expected[name].values, equal_nan=True
+            )
+            for name in expected.columns
+        )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "data.tsv")
+        cache_dir = cache_dir_for(path)
+        expected = write_tsv(path, 100, 0)
+        build(path)
+        if read_manifest(path, cache_dir) is None:
+            raise Exception("expected a freshly built cache to be used")
+        columns, errors, stats = load(path)
+        if not same(columns, expected) or errors:
+            raise Exception("expected the cache to round trip the tsv")
+        if set(stats) != set(expected.columns):
+            raise Exception("expected stats for every column, got %r" % sorted(stats))
+        values = columns["lat"].values
+        if values.flags.writeable:
+            raise Exception("expected memory-mapped columns to be read only")
+        try:
+            values[0] = 0
+        except ValueError:
+            pass
+        else:
+            raise Exception("expected writing to a cached column to fail")
+
+        if read_manifest(path, cache_dir, "float32") is not None:
+            raise Exception("expected a cache at another dtype to miss")
+        columns, errors, _ = load(path, dtype="float32")
+        if columns["tmean_avg_2050"].dtype != np.float32 or not errors:
+            raise Exception("expected a dtype miss to parse the tsv at that dtype")
+
+        manifest_path = os.path.join(cache_dir, MANIFEST)
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+        manifest["version"] = FORMAT_VERSION - 1
+        with open(manifest_path, "w") as fh:
+            json.dump(manifest, fh)
+        if read_manifest(path, cache_dir) is not None:
+            raise Exception("expected a cache in an older format to miss")
+
+        build(path)
+        expected = write_tsv(path + ".new", 120, 1)
+        os.replace(path + ".new", path)
+        if read_manifest(path, cache_dir) is not None:
+            raise Exception("expected a cache of an older tsv to miss")
+        columns, _, _ = load(path)
+        if not same(columns, expected):
+            raise Exception("expected a stale cache to fall back to the tsv")
+
+        build(path, dtype="float32")
+        columns, errors, _ = load(path, dtype="float32")
+        if read_manifest(path, cache_dir, "float32") is None:
+            raise Exception("expected the float32 cache to be used")
+        for name in EXACT_COLUMNS:
+            if columns[name].dtype != np.float64 or not np.array_equal(
+                columns[name].values.view(np.uint64),
+                expected[name].values.view(np.uint64),
+            ):
+                raise Exception("expected %s to be stored bit for bit" % name)
+        if columns["tmean_avg_2050"].dtype != np.float32:
+            raise Exception("expected other float columns stored as float32")
+        if columns["count"].dtype != expected["count"].dtype:
+            raise Exception("expected integer columns stored as parsed")
+        original = expected["tmean_avg_2050"].values
+        if sorted(errors) != ["tmean_avg_2050"] or errors["tmean_avg_2050"] != (
+            storage_error(original, original.astype(np.float32))
+        ):
+            raise Exception("expected the float32 error to be recorded, %r" % errors)
+        if not 0 < errors["tmean_avg_2050"]["max_rel"] < 1e-7:
+            raise Exception("unexpected float32 error %r" % errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build the cache for a data tsv")
+    parser.add_argument("tsv", nargs="?", default="data.tsv")
+    parser.add_argument("--dtype", help="store float columns at this precision")
+    parser.add_argument("--test", action="store_true", help="run the tests instead")
+    args = parser.parse_args()
+    if args.test:
+        run_tests()
+    else:
+        build(args.tsv, dtype=args.dtype)
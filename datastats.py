@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+summary statistics of a dataset's numeric columns: min, max, quantiles and
+a fixed-bin histogram. they're computed in one vectorized pass when a
+dataset's cache is built (or when it's loaded straight from its tsv) and
+stored with it, so request handlers only ever look them up.
+"""
+
+import warnings
+
+import numpy as np
+
+import uel
+
+# symmetric, so that converted() can mirror them for negative scales
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+BINS = 64
+
+# compute() works through this many float64 cells of columns at a time
+CHUNK_CELLS = 2**23
+
+
+class ColumnStats:
+    """
+    a column's length, how many of its values aren't NaN, their min and max,
+    their values at QUANTILES, how many of them fall in each of BINS
+    equal-width bins from min to max, and whether they're all integers.
+    """
+
+    def __init__(self, length, count, min, max, quantiles, counts, integral):
+        self.length = length
+        self.count = count
+        self.min = min
+        self.max = max
+        self.quantiles = quantiles
+        self.counts = counts
+        self.integral = integral
+
+    def __repr__(self):
+        return "ColumnStats(count=%d, min=%r, max=%r)" % (
+            self.count,
+            self.min,
+            self.max,
+        )
+
+    def to_json(self):
+        return {
+            "length": self.length,
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "quantiles": self.quantiles,
+            "counts": self.counts,
+            "integral": self.integral,
+        }
+
+    @classmethod
+    def from_json(cls, fields):
+        return cls(**fields)
+
+    def quantile(self, q):
+        return self.quantiles[QUANTILES.index(q)]
+
+    def converted(self, scale, offset):
+        """
+        the stats of scale * column + offset.
+        """
+        lo, hi = self.min * scale + offset, self.max * scale + offset
+        quantiles = [value * scale + offset for value in self.quantiles]
+        counts = list(self.counts)
+        if scale < 0:
+            lo, hi = hi, lo
+            quantiles.reverse()
+            counts.reverse()
+        integral = self.integral and scale == int(scale) and offset == int(offset)
+        return ColumnStats(self.length, self.count, lo, hi, quantiles, counts, integral)
+
+    def bin(self, value):
+        width = (self.max - self.min) / BINS
+        if not width > 0:
+            return 0, 0.0
+        position = min((value - self.min) / width, BINS)
+        i = min(int(position), BINS - 1)
+        return i, position - i
+
+    def below(self, value):
+        """
+        estimates how many values are less than value, taking values to be
+        spread evenly within each bin.
+        """
+        if self.count == 0 or value <= self.min:
+            return 0.0
+        if value > self.max:
+            return float(self.count)
+        i, within = self.bin(value)
+        return min(float(self.count), sum(self.counts[:i]) + self.counts[i] * within)
+
+    def fraction(self, cls, value):
+        """
+        estimates the fraction of rows where column <cls> value holds, for
+        cls one of uel's comparison classes. like the ufuncs, only != holds
+        for NaNs.
+        """
+        if self.length == 0:
+            return 0.0
+        if value != value:
+            return 1.0 if cls is uel.OpNotEqual else 0.0
+        if cls in (uel.OpEqual, uel.OpNotEqual):
+            # a value in a column of integers takes its share of the bin.
+            # other columns are taken to be continuous, so no row matches.
+            equal = 0.0
+            if self.integral and self.min <= value <= self.max and value == int(value):
+                width = (self.max - self.min) / BINS
+                equal = self.counts[self.bin(value)[0]] / max(1.0, width)
+            matched = equal if cls is uel.OpEqual else self.length - equal
+        elif cls in (uel.OpLess, uel.OpLessEqual):
+            matched = self.below(value)
+        else:
+            matched = self.count - self.below(value)
+        return min(1.0, max(0.0, matched / self.length))
+
+
+def compute(columns):
+    """
+    returns ColumnStats for each numeric array in columns, a dict of name to
+    arrays that are all the same length.
+    """
+    names = [name for name, values in columns.items() if values.dtype.kind in "iuf"]
+    stats = {}
+    if not names:
+        return stats
+    length = len(columns[names[0]])
+    step = max(1, CHUNK_CELLS // max(1, length))
+    for start in range(0, len(names), step):
+        chunk = names[start : start + step]
+        table = np.column_stack(
+            [np.asarray(columns[name], dtype=np.float64) for name in chunk]
+        )
+        valid = ~np.isnan(table)
+        count = valid.sum(axis=0)
+        integral = np.all((table == np.floor(table)) | ~valid, axis=0)
+        with warnings.catch_warnings():
+            # all-NaN columns get NaN stats, which is fine
+            warnings.simplefilter("ignore", RuntimeWarning)
+            lo = np.nanmin(table, axis=0)
+            hi = np.nanmax(table, axis=0)
+            quantiles = np.nanquantile(table, QUANTILES, axis=0)
+        width = (hi - lo) / BINS
+        width[~(width > 0)] = 1
+        with np.errstate(invalid="ignore"):
+            bins = np.clip(np.floor((table - lo) / width), 0, BINS - 1)
+        bins += np.arange(len(chunk)) * BINS
+        counts = np.bincount(
+            bins[valid].astype(np.intp), minlength=len(chunk) * BINS
+        ).reshape(len(chunk), BINS)
+        for i, name in enumerate(chunk):
+            stats[name] = ColumnStats(
+                length,
+                int(count[i]),
+                float(lo[i]),
+                float(hi[i]),
+                quantiles[:, i].tolist(),
+                counts[i].tolist(),
+                bool(integral[i]),
+            )
+    return stats
+
+
+def run_tests():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=10000)
+    a[::10] = np.nan
+    n = rng.integers(0, 100, size=10000)
+    stats = compute({"a": a, "n": n, "s": np.array(["x"] * 10000)})
+    if sorted(stats) != ["a", "n"]:
+        raise Exception("expected stats for numeric columns only, got %r" % stats)
+    if stats["a"].count != 9000 or stats["a"].min != np.nanmin(a):
+        raise Exception("bad stats for a: %r" % stats["a"])
+    if sum(stats["n"].counts) != 10000 or stats["n"].max != 99:
+        raise Exception("bad histogram for n: %r" % stats["n"].counts)
+    if not np.allclose(stats["a"].quantiles, np.nanquantile(a, QUANTILES)):
+        raise Exception("bad quantiles for a: %r" % stats["a"].quantiles)
+
+    for value in (-3, -0.5, 0, 0.7, 2.5):
+        for cls in (uel.OpLess, uel.OpGreaterEqual, uel.OpNotEqual):
+            for name, column in (("a", a), ("n", n)):
+                expected = np.mean(uel.DEFAULT_ENV[cls](column, value))
+                estimated = stats[name].fraction(cls, value)
+                if abs(estimated - expected) > 0.02:
+                    raise Exception(
+                        "%s %s %r: estimated %r, expected %r"
+                        % (name, cls.__name__, value, estimated, expected)
+                    )
+    if abs(stats["n"].fraction(uel.OpEqual, 42) - np.mean(n == 42)) > 0.01:
+        raise Exception("bad equality estimate for n")
+
+    flipped = stats["a"].converted(-2, 1)
+    if flipped.min != stats["a"].max * -2 + 1:
+        raise Exception("bad converted min %r" % flipped.min)
+    if abs(flipped.quantile(0.25) - np.nanquantile(a * -2 + 1, 0.25)) > 1e-9:
+        raise Exception("bad converted quantile %r" % flipped.quantile(0.25))
+    expected = np.mean(a * -2 + 1 < 0.5)
+    if abs(flipped.fraction(uel.OpLess, 0.5) - expected) > 0.02:
+        raise Exception("bad converted estimate")
+
+    if ColumnStats.from_json(stats["a"].to_json()).counts != stats["a"].counts:
+        raise Exception("expected stats to round trip")
+
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+an LRU cache for rendered map figures and tiles, bounded by the bytes of
+their serialized JSON or PNG rather than by how many there are, since one
+figure can be a few hundred bytes or several megabytes.
+"""
+
+import collections
+import threading
+
+
+class FigureCache:
+    """
+    maps keys to (json, extra) pairs, dropping the least recently used once
+    the json strings (or PNG bytes) add up to more than max_bytes. a figure
+    bigger than max_bytes on its own isn't kept at all. safe to use from
+    several threads.
+
+    put can be given the size of anything else to keep within the same
+    budget, like the arrays tiles are rendered from.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, json, extra=None, size=None):
+        if size is None:
+            size = len(json)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                del self.entries[key]
+                self.nbytes -= self.sizes.pop(key)
+            self.entries[key] = (json, extra)
+            self.sizes[key] = size
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                dropped, _ = self.entries.popitem(last=False)
+                self.nbytes -= self.sizes.pop(dropped)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": lookups and self.hits / float(lookups),
+                "evictions": self.evictions,
+            }
+
+
+def run_tests():
+    cache = FigureCache(10)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb", "extra")
+    if cache.get("a") != ("aaaa", None) or cache.get("b") != ("bbbb", "extra"):
+        raise Exception("expected both figures to be cached")
+    cache.get("a")
+    cache.put("c", "cccc")
+    if cache.get("b") is not None or cache.get("a") is None:
+        raise Exception("expected the least recently used figure to be dropped")
+    cache.put("huge", "x" * 11)
+    if cache.get("huge") is not None or cache.stats()["bytes"] != 8:
+        raise Exception("expected a figure over the budget not to be cached")
+    cache.put("a", "aa")
+    stats = cache.stats()
+    if stats["bytes"] != 6 or stats["evictions"] != 1:
+        raise Exception("unexpected stats %r" % stats)
+    if stats["hits"] != 4 or stats["misses"] != 2:
+        raise Exception("unexpected hit counts %r" % stats)
+
+    cache.put("sized", ("any", "value"), size=4)
+    if cache.get("sized") != (("any", "value"), None) or cache.nbytes != 10:
+        raise Exception("expected an entry to count for the size it was given")
+    cache.put("c", "c" * 9)
+    if cache.get("sized") is not None or cache.nbytes != 9:
+        raise Exception("expected sized entries to be dropped by their size")
+
+
+if __name__ == "__main__":
+    run_tests()
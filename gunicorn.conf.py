@@ -0,0 +1,17 @@
+# gunicorn reads this from the working directory on startup.
+
+import os
+
+# with CLIMATEDASH_PRELOAD=1, the app, and with it the default dataset, is
+# loaded once in the master process before the workers are forked. workers
+# then share the dataset's raw columns copy-on-write, but build their own
+# converted columns and indexes as they're used. see PRELOAD in index.py.
+preload_app = os.environ.get("CLIMATEDASH_PRELOAD", "0") == "1"
+
+# each worker serves requests from a pool of threads rather than one at a
+# time, so a client's newer map query can be received while its older one
+# is still being evaluated, which then stops early (see LatestQueries in
+# index.py) and frees its thread. set CLIMATEDASH_THREADS to change how many
+# threads each worker has.
+worker_class = "gthread"
+threads = int(os.environ.get("CLIMATEDASH_THREADS", "4"))
@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
 
+import startup
+
+import base64
+import collections
+import functools
+import hashlib
+import json
+import logging
 import os
+import threading
 import dash
+import flask
 from dash import dcc
 from dash import html
 from dash_dangerously_set_inner_html import DangerouslySetInnerHTML as RawHTML
@@ -11,20 +21,67 @@ import pandas as pd
 import numpy as np
 from urllib.parse import parse_qs, urlencode
 
-import uel, uel_conjunct
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+import uel, uel_conjunct, uel_numpy, typedarrays, tiles
+from figurecache import FigureCache
 from data import (
     valueChooserNames,
     timeChooserNames,
     varname,
-    df,
-    UEL_ENV,
-    UEL_ENV_CHECK,
+    DATASETS,
+    dataset_key,
+    dataset_name,
     comparators,
     presentValuesOnly,
     valueChooserVals,
     timeChooserVals,
 )
 
+startup.mark("import")
+
+# CLIMATEDASH_PRELOAD=1 loads the default dataset while this is imported.
+# gunicorn.conf.py then also turns on preload_app, so that happens once in
+# the gunicorn master, and workers share its raw columns and spatial index.
+# converted columns and sorted indexes are built lazily, so each worker
+# still builds its own after the fork, on first use. without it, each
+# worker loads the dataset on a background thread after importing this, so
+# it can accept connections straight away. requests that come in before
+# it's loaded wait for it.
+PRELOAD = os.environ.get("CLIMATEDASH_PRELOAD", "0") == "1"
+
+# "blockwise" evaluates expressions a block of rows at a time with bounded
+# scratch memory, "vector" evaluates each operation over whole columns.
+EVAL_MODE = os.environ.get("UEL_EVAL_MODE", "blockwise")
+
+# how long, in milliseconds, typing in the advanced tab's text boxes (or a
+# filter's limit) has to stop for before the map is redrawn. parse and type
+# errors are shown as they're typed.
+TYPING_DEBOUNCE_MS = int(os.environ.get("CLIMATEDASH_DEBOUNCE_MS", "300"))
+
+# the map's coordinates and colors are sent as base64 typed arrays, at
+# float32 for floats. set CLIMATEDASH_BINARY_ARRAYS=0 to send them as JSON
+# lists at full precision instead.
+BINARY_ARRAYS = os.environ.get("CLIMATEDASH_BINARY_ARRAYS", "1") != "0"
+
+# the map points (see update_map) most recently drawn, as JSON, so that going
+# back to an earlier selection and filter doesn't evaluate them again. set
+# CLIMATEDASH_FIGURE_CACHE_MB to change how much memory they can take.
+FIGURES = FigureCache(
+    int(float(os.environ.get("CLIMATEDASH_FIGURE_CACHE_MB", "64")) * 2**20)
+)
+
+# results with more points than this are drawn from an image of the map's
+# view rendered here (see tiles.py) instead of one marker each, which
+# browsers slow down on. the images most recently rendered are kept as PNGs,
+# along with the grids they're rendered from, up to
+# CLIMATEDASH_TILE_CACHE_MB. set CLIMATEDASH_RASTER_POINTS=0 to always draw
+# markers.
+RASTER_POINTS = int(os.environ.get("CLIMATEDASH_RASTER_POINTS", "50000"))
+TILES = FigureCache(
+    int(float(os.environ.get("CLIMATEDASH_TILE_CACHE_MB", "64")) * 2**20)
+)
+
 app = dash.Dash(
     __name__,
     title="JT's Climate Dashboard",
@@ -76,6 +133,22 @@ app.layout = html.Div(
             [
                 html.H1("JT's Climate Dashboard"),
                 dcc.Location(id="url"),
+                # the dataset, version, selection and filter the map shows.
+                # draw_ui writes them to map-pending when one of them
+                # changes, and assets/debounce.js copies that to map-query,
+                # straight away or, while they're being typed, once the
+                # typing stops for TYPING_DEBOUNCE_MS. draw_map redraws the
+                # map when map-query changes.
+                dcc.Store(id="map-pending"),
+                dcc.Store(id="map-query"),
+                dcc.Interval(
+                    id="typing-interval", interval=TYPING_DEBOUNCE_MS, disabled=True
+                ),
+                # the coordinates of the dataset's rows, from map_coordinates,
+                # and which of them to show in what colors, from update_map.
+                # assets/climatemap.js draws the map from the two.
+                dcc.Store(id="map-coords"),
+                dcc.Store(id="map-points"),
             ]
         ),
         dbc.Row(
@@ -109,6 +182,7 @@ def draw_simple_ui(
     filter_comps,
     filter_limits,
     filter_dels,
+    stats,
 ):
     selection_expr, filter_expr = "", ""
     if len(selected_val) != 1:
@@ -299,13 +373,16 @@ def draw_simple_ui(
             draw_filter(filter_val, filter_time, filter_comp, filter_limit, i - deletes)
 
     if sum([x for x in add_filter_clicks if x is not None]) > 0:
-        draw_filter(
-            list(valueChooserNames.values())[0],
-            list(timeChooserNames.values())[1],
-            comparators[0],
-            None,
-            len(filter_vals) - deletes,
+        value = list(valueChooserNames.values())[0]
+        time = list(timeChooserNames.values())[1]
+        # start from the median, which keeps about half of the map
+        limit = None
+        value_stats = stats.get(
+            value if value in presentValuesOnly else value + "_" + time
         )
+        if value_stats is not None and value_stats.count > 0:
+            limit = float("%.3g" % value_stats.quantile(0.5))
+        draw_filter(value, time, comparators[0], limit, len(filter_vals) - deletes)
 
     within_tab.extend(
         [
@@ -334,8 +411,12 @@ def draw_advanced_ui(selection_box, filter_box):
     if len(filter_box) != 1:
         filter_box = [""]
 
-    selection_error_div = html.P(style={"color": "red"})
-    filter_error_div = html.P(style={"color": "red"})
+    selection_error_div = html.P(
+        id={"type": "selection-error", "index": 0}, style={"color": "red"}
+    )
+    filter_error_div = html.P(
+        id={"type": "filter-error", "index": 0}, style={"color": "red"}
+    )
 
     return (
         [
@@ -399,17 +480,42 @@ def draw_docs_ui(selection_box, filter_box):
     )
 
 
-def parse_simple(selection_expr, filter_expr):
-    if selection_expr.strip() == "":
-        return None, None
+def parse_expressions(dataset, selection_expr, filter_expr):
+    """
+    parses and checks a selection and filter against the variables in
+    dataset, returning the parsed selection,
+    the parsed filter, and an error message for each ("" if there's none).
+    draw_ui does this once per pair of texts it sees, and parse_simple works
+    from the result.
+    """
+    selection_parsed, selection_error = None, ""
     try:
-        selection_parsed = uel_conjunct.identifier_parse(selection_expr)
-        selection_parsed.run(UEL_ENV_CHECK)
-        filter_parsed = None
-        if filter_expr.strip() != "":
-            filter_parsed = uel_conjunct.conjunction_parse(filter_expr)
-            filter_parsed.run(UEL_ENV_CHECK)
-    except (uel.ParserError, uel.UnboundVariableError):
+        selection_parsed = uel.uel_parse(selection_expr)
+        uel.check(selection_parsed, dataset.symbols)
+    except (uel.UnboundVariableError, uel.ParserError, uel.TypeCheckError) as e:
+        selection_parsed, selection_error = None, str(e)
+
+    filter_parsed, filter_error = None, ""
+    if filter_expr.strip() != "":
+        try:
+            filter_parsed = uel.uel_parse(filter_expr)
+            uel.check(filter_parsed, dataset.symbols, uel.BOOLEAN)
+        except (uel.UnboundVariableError, uel.ParserError, uel.TypeCheckError) as e:
+            filter_parsed, filter_error = None, str(e)
+
+    return selection_parsed, filter_parsed, selection_error, filter_error
+
+
+def parse_simple(parsed):
+    selection_parsed, filter_parsed, selection_error, filter_error = parsed
+    if selection_error != "" or filter_error != "":
+        return None, None
+    if not uel_conjunct.is_identifier(selection_parsed):
+        return None, None
+    if (
+        filter_parsed is not None
+        and uel_conjunct.conjunction_parts(filter_parsed) is None
+    ):
         return None, None
     return selection_parsed, filter_parsed
 
@@ -417,7 +523,7 @@ def parse_simple(selection_expr, filter_expr):
 @app.callback(
     [
         dash.Output("controls", "children"),
-        dash.Output("climatemap", "figure"),
+        dash.Output("map-pending", "data"),
     ],
     [
         dash.Input("url", "search"),
@@ -433,7 +539,9 @@ def parse_simple(selection_expr, filter_expr):
         dash.Input({"type": "last-tab", "index": dash.ALL}, "value"),
         dash.Input({"type": "selection-box", "index": dash.ALL}, "value"),
         dash.Input({"type": "filter-box", "index": dash.ALL}, "value"),
+        dash.Input({"type": "dataset-chooser", "index": dash.ALL}, "value"),
     ],
+    [dash.State("map-pending", "data")],
 )
 def draw_ui(
     query,
@@ -449,9 +557,13 @@ def draw_ui(
     last_tab,
     selection_box,
     filter_box,
+    dataset_choice,
+    map_pending,
 ):
     if len(ui_tab) == 0 and len(last_tab) == 0:
         query = parse_qs(query.lstrip("?"))
+        if "dataset" in query:
+            dataset_choice = [query["dataset"][-1]]
         if "selection" in query and query["selection"][-1].strip():
             last_tab = ["tab-advanced"]
             if "tab" in query and query["tab"][-1] == "advanced":
@@ -464,16 +576,26 @@ def draw_ui(
             else:
                 filter_box = [""]
 
+    # the whole callback works from one version of the dataset, even if a
+    # reload finishes while it runs.
+    dataset_chosen = DATASETS.default
+    if len(dataset_choice) > 0 and dataset_key(dataset_choice[0]) in DATASETS.paths:
+        dataset_chosen = dataset_key(dataset_choice[0])
+    dataset = DATASETS.get(dataset_chosen)
+
+    parsed, parsed_exprs = None, None
     good_for_simple = True
     if len(selection_box) > 1:
         good_for_simple = False
     if len(filter_box) > 1:
         good_for_simple = False
     if good_for_simple:
-        selection_parsed, filter_parsed = parse_simple(
+        parsed_exprs = (
             len(selection_box) > 0 and selection_box[0] or "",
             len(filter_box) > 0 and filter_box[0] or "",
         )
+        parsed = parse_expressions(dataset, *parsed_exprs)
+        selection_parsed, filter_parsed = parse_simple(parsed)
         if selection_parsed is None and (
             len(selection_box) != 0 or len(filter_box) != 0
         ):
@@ -502,21 +624,15 @@ def draw_ui(
             filter_vals, filter_times, filter_comps, filter_limits = [], [], [], []
             filter_dels = []
 
-            def walk_conjunctions(expr):
-                if isinstance(expr, uel.OpAnd):
-                    walk_conjunctions(expr.lhs)
-                    walk_conjunctions(expr.rhs)
-                    return
-                assert expr.op in comparators
-                name, time = parsevar(expr.lhs.name)
-                filter_vals.append(name)
-                filter_times.append(time)
-                filter_comps.append(expr.op)
-                filter_limits.append(expr.rhs.run({}))
-                filter_dels.append(None)
-
             if filter_parsed is not None:
-                walk_conjunctions(filter_parsed)
+                for expr in uel_conjunct.conjunction_parts(filter_parsed):
+                    assert expr.op in comparators
+                    name, time = parsevar(expr.lhs.name)
+                    filter_vals.append(name)
+                    filter_times.append(time)
+                    filter_comps.append(expr.op)
+                    filter_limits.append(expr.rhs.run({}))
+                    filter_dels.append(None)
 
     selection_expr = ""
     filter_expr = ""
@@ -524,7 +640,7 @@ def draw_ui(
     selection_error_div, filter_error_div = None, None
     if len(ui_tab) == 1 and ui_tab[0] == "tab-docs":
         selected_tab = "tab-docs"
-        (within_tab, selection_expr, filter_expr) = draw_docs_ui(
+        within_tab, selection_expr, filter_expr = draw_docs_ui(
             selection_box, filter_box
         )
     elif len(ui_tab) == 1 and ui_tab[0] == "tab-advanced":
@@ -546,9 +662,12 @@ def draw_ui(
             filter_comps,
             filter_limits,
             filter_dels,
+            dataset.stats,
         )
 
-    map_graph, selection_error, filter_error = update_map(selection_expr, filter_expr)
+    if parsed is None or parsed_exprs != (selection_expr, filter_expr):
+        parsed = parse_expressions(dataset, selection_expr, filter_expr)
+    selection_error, filter_error = parsed[2], parsed[3]
     if selection_error_div is not None:
         selection_error_div.children = [selection_error]
     if filter_error_div is not None:
@@ -572,23 +691,23 @@ def draw_ui(
     tabs.append(dbc.Tab(label="Docs", tab_id="tab-docs"))
 
     if selected_tab in ("tab-simple", "tab-advanced"):
+        share = {
+            "selection": selection_expr,
+            "filter": filter_expr,
+        }
+        if dataset_chosen != DATASETS.default:
+            share["dataset"] = dataset_name(dataset_chosen)
         within_tab.append(
             html.Div(
                 style={"text-align": "right"},
                 children=dbc.Button(
                     children="Share to URL",
-                    href="?"
-                    + urlencode(
-                        {
-                            "selection": selection_expr,
-                            "filter": filter_expr,
-                        }
-                    ),
+                    href="?" + urlencode(share),
                 ),
             ),
         )
 
-    return [
+    controls = [
         dbc.Card(
             [
                 dbc.CardHeader(
@@ -606,61 +725,571 @@ def draw_ui(
             value=selected_tab,
             style={"display": "none"},
         ),
-    ], map_graph
+    ]
+    if len(DATASETS.keys()) > 1:
+        controls.insert(
+            0,
+            dbc.InputGroup(
+                [
+                    dbc.InputGroupText("Grid, scenario, bias correction"),
+                    dbc.Select(
+                        options=[
+                            {"label": ", ".join(key), "value": dataset_name(key)}
+                            for key in DATASETS.keys()
+                        ],
+                        value=dataset_name(dataset_chosen),
+                        id={"type": "dataset-chooser", "index": 0},
+                    ),
+                ],
+                className="mb-3",
+            ),
+        )
 
+    # edits that don't change what the map shows, like adding a filter
+    # without a limit yet or switching to the docs, leave the map alone.
+    # the errors above are all there is to show until typing stops.
+    query = {
+        "dataset": dataset_name(dataset_chosen),
+        "version": dataset.version,
+        "selection": selection_expr,
+        "filter": filter_expr,
+    }
+    if map_pending is not None and all(
+        map_pending.get(name) == value for name, value in query.items()
+    ):
+        query = dash.no_update
+    else:
+        query["typed"] = triggered_by_typing()
 
-def update_map(selection_expr, filter_expr):
-    data_col, lat, lon = None, None, None
+    return controls, query
 
-    selection_error = ""
-    try:
-        uel.uel_eval(selection_expr, UEL_ENV_CHECK)
-    except (uel.UnboundVariableError, uel.ParserError, KeyError) as e:
-        selection_error = str(e)
-        selection_expr = ""
 
-    filter_error = ""
-    if filter_expr.strip() != "":
-        try:
-            uel.uel_eval(filter_expr, UEL_ENV_CHECK)
-        except (uel.UnboundVariableError, uel.ParserError, KeyError) as e:
-            filter_error = str(e)
-            selection_expr = ""
-
-    if selection_expr.strip() != "":
-        data_col = uel.uel_eval(selection_expr, UEL_ENV)
-        if data_col is not None:
-            lat = df["lat"]
-            lon = df["lon"]
-            if filter_expr.strip() != "":
-                filter = uel.uel_eval(filter_expr, UEL_ENV)
-                try:
-                    data_col = data_col[filter]
-                    lat = lat[filter]
-                    lon = lon[filter]
-                except KeyError:
-                    filter_error = "invalid filter"
-                    data_col, lat, lon = None, None, None
-
-    fig = go.Figure(
-        data=go.Scattergeo(
-            lat=lat,
-            lon=lon,
-            mode="markers",
-            marker_showscale=True,
-            marker_color=data_col,
-            text=data_col,
+# the inputs that change with every keystroke
+TYPED_INPUTS = ("selection-box", "filter-box", "filter-limit")
+
+
+def triggered_by_typing():
+    for trigger in dash.callback_context.triggered:
+        prop_id = trigger["prop_id"].rsplit(".", 1)[0]
+        if prop_id.startswith("{") and json.loads(prop_id)["type"] in TYPED_INPUTS:
+            return True
+    return False
+
+
+class LatestQueries:
+    """
+    the latest map-query sequence number each client has sent, so that an
+    evaluation that's been overtaken by a newer one from the same client can
+    be dropped instead of finishing. each process only knows about the
+    requests it gets, and a newer request can only arrive while an older one
+    is being evaluated if the process serves several at once, so
+    gunicorn.conf.py runs workers with threads. the clients seen longest ago
+    are forgotten once there are more than max_clients.
+    """
+
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self.latest = collections.OrderedDict()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def start(self, client, seq):
+        with self.lock:
+            if seq > self.latest.get(client, -1):
+                self.latest[client] = seq
+            self.latest.move_to_end(client)
+            while len(self.latest) > self.max_clients:
+                self.latest.popitem(last=False)
+
+    def stale(self, client, seq):
+        with self.lock:
+            stale = self.latest.get(client, seq) > seq
+            self.dropped += stale
+            return stale
+
+
+QUERIES = LatestQueries()
+
+
+@app.callback(
+    [
+        dash.Output("map-points", "data"),
+        dash.Output({"type": "selection-error", "index": dash.ALL}, "children"),
+        dash.Output({"type": "filter-error", "index": dash.ALL}, "children"),
+    ],
+    [
+        dash.Input("map-query", "data"),
+        dash.Input("climatemap", "relayoutData"),
+    ],
+)
+def draw_map(map_query, relayout):
+    if map_query is None:
+        raise dash.exceptions.PreventUpdate
+    client, seq = map_query.get("client"), map_query.get("seq", 0)
+    QUERIES.start(client, seq)
+    # the version draw_ui saw, so the points, their coordinates and tiles
+    # all agree on it whichever process each request goes to
+    dataset = DATASETS.get(dataset_key(map_query["dataset"]), map_query["version"])
+    parsed = parse_expressions(dataset, map_query["selection"], map_query["filter"])
+    # the client only shows the response to its latest request, so one
+    # that's been overtaken while it waited isn't worth evaluating, nor
+    # sending once it's evaluated.
+    if QUERIES.stale(client, seq):
+        raise dash.exceptions.PreventUpdate
+    try:
+        points, selection_error, filter_error = update_map(
+            dataset,
+            *parsed,
+            viewport=viewport(relayout),
+            cancelled=lambda: QUERIES.stale(client, seq),
         )
+    except uel_numpy.Cancelled:
+        raise dash.exceptions.PreventUpdate
+    if QUERIES.stale(client, seq):
+        raise dash.exceptions.PreventUpdate
+    points["dataset"] = map_query["dataset"]
+    if "raster" in points:
+        points["raster"]["url"] = tile_url(map_query, points)
+    # draw_ui shows the parse errors, but evaluating can turn up more. the
+    # error boxes are only there on the advanced tab.
+    _, selection_errors, filter_errors = dash.callback_context.outputs_list
+    return (
+        points,
+        [[selection_error]] * len(selection_errors),
+        [[filter_error]] * len(filter_errors),
     )
+
+
+@app.callback(
+    dash.Output("map-coords", "data"),
+    [dash.Input("map-query", "data"), dash.Input("map-points", "data")],
+    [dash.State("map-coords", "data")],
+)
+def draw_coords(map_query, map_points, map_coords):
+    # the coordinates are sent as soon as the query changes, so they can
+    # arrive along with the points, and again if the points turn out to be
+    # for another version. climatemap.js only draws points with coordinates
+    # of the same version, which may not be this process's current one.
+    triggered = [trigger["prop_id"] for trigger in dash.callback_context.triggered]
+    wanted = map_points if "map-points.data" in triggered else map_query
+    if wanted is None:
+        raise dash.exceptions.PreventUpdate
+    name, version = wanted["dataset"], wanted["version"]
+    if map_coords is not None and (map_coords["dataset"], map_coords["version"]) == (
+        name,
+        version,
+    ):
+        return dash.no_update
+    dataset = DATASETS.get(dataset_key(name), version)
+    return dict(map_coordinates(dataset), dataset=name)
+
+
+app.clientside_callback(
+    dash.ClientsideFunction(namespace="debounce", function_name="settle"),
+    [
+        dash.Output("map-query", "data"),
+        dash.Output("typing-interval", "disabled"),
+    ],
+    [
+        dash.Input("map-pending", "data"),
+        dash.Input("typing-interval", "n_intervals"),
+    ],
+    [
+        dash.State("map-query", "data"),
+        dash.State("typing-interval", "interval"),
+    ],
+)
+
+
+app.clientside_callback(
+    dash.ClientsideFunction(namespace="climatemap", function_name="draw"),
+    dash.Output("climatemap", "figure"),
+    [dash.Input("map-points", "data"), dash.Input("map-coords", "data")],
+)
+
+
+# the degrees of latitude and longitude geo_scope="usa" shows unzoomed, and
+# its center latitude. zoomed in, the map only gets the points in a box this
+# many times larger than what's in view, so short pans don't show gaps.
+USA_SPAN = (28.0, 60.0)
+USA_CENTER_LAT = 38.0
+VIEWPORT_PADDING = 1.5
+
+
+def viewport(relayout):
+    """
+    returns the (lat_min, lat_max, lon_min, lon_max) box to send points for,
+    from the map's relayoutData, or None if it's zoomed all the way out.
+    """
+    try:
+        scale = float(relayout["geo.projection.scale"])
+        lat = float(relayout["geo.center.lat"])
+        lon = float(relayout["geo.center.lon"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not scale > 1:
+        return None
+    lat_half = USA_SPAN[0] * VIEWPORT_PADDING / scale / 2
+    # a degree of longitude gets narrower towards the poles
+    lon_half = (
+        USA_SPAN[1]
+        * VIEWPORT_PADDING
+        / scale
+        / 2
+        * np.cos(np.radians(USA_CENTER_LAT))
+        / np.cos(np.radians(min(abs(lat) + lat_half, 80.0)))
+    )
+    lon_half = float(lon_half)
+    return lat - lat_half, lat + lat_half, lon - lon_half, lon + lon_half
+
+
+def evaluate(exprs, env, cancelled=None):
+    if EVAL_MODE == "blockwise":
+        return uel_numpy.evaluate_blockwise(exprs, env, cancelled=cancelled)
+    return uel.compile_all(exprs, env)(env)
+
+
+@functools.lru_cache(maxsize=None)
+def base_figure():
+    """
+    the map as drawn before any points are added. assets/climatemap.js fills
+    in the trace's coordinates, colors and text. it's built on first use,
+    since plotly's validators are slow to load.
+    """
+    fig = go.Figure(data=go.Scattergeo(mode="markers", marker_showscale=True))
     fig.update_layout(
         geo_scope="usa",
         margin={"l": 0, "r": 0, "t": 0, "b": 0},
         modebar_remove=["select2d", "lasso2d"],
         uirevision="static",
     )
-    return fig, selection_error, filter_error
+    return fig.to_plotly_json()
+
+
+def map_coordinates(dataset):
+    """
+    the coordinates of every row of dataset, and the figure to draw them
+    on. the browser keeps them in the map-coords store, so they're only sent
+    once per dataset version, and each update_map after that only sends
+    which rows are shown and their colors.
+    """
+    return {
+        "version": dataset.version,
+        "lat": typedarrays.encode(dataset.df["lat"].values, BINARY_ARRAYS),
+        "lon": typedarrays.encode(dataset.df["lon"].values, BINARY_ARRAYS),
+        "figure": base_figure(),
+    }
+
+
+def pack_rows(rows, length):
+    """
+    a bitmask of which of length rows are in rows, or all of them if rows is
+    None, packed eight rows to a byte, lowest bit first, in base64.
+    """
+    mask = np.zeros(length, dtype=bool)
+    mask[slice(None) if rows is None else rows] = True
+    return base64.b64encode(np.packbits(mask, bitorder="little")).decode("ascii")
+
+
+def map_values(dataset, selection_parsed, filter_parsed, viewport=None, cancelled=None):
+    """
+    evaluates a selection and filter that have been through uel.optimize,
+    returning the color of each row that's shown, in row order, and the
+    sorted indexes of those rows, or None if every row is. the colors are
+    None if the selection has no value. an invalid filter raises KeyError or
+    IndexError, and uel_numpy.Cancelled is raised if cancelled returns true
+    while it's working.
+    """
+    env, indexes = dataset.env, dataset.indexes
+    rows, visible = None, None
+    if viewport is not None:
+        # only the rows in view are evaluated and sent. the indexes are
+        # over every row, so they're no use for the rest.
+        visible = dataset.spatial.query(*viewport)
+        env = uel_numpy.narrow(env, selection_parsed, visible)
+        env.update(uel_numpy.narrow(dataset.env, filter_parsed, visible))
+        indexes = None
+    if (
+        filter_parsed is not None
+        and (
+            len(uel_numpy.conjuncts(filter_parsed)) > 1
+            or uel_numpy.index_lookup(filter_parsed, indexes) is not None
+        )
+        and uel_numpy.column_length(filter_parsed, env) is not None
+        and not uel_numpy.shares_subtrees([selection_parsed, filter_parsed])
+    ):
+        # narrow the rows down one conjunct at a time, using the sorted
+        # indexes where possible, and then only compute the selection for
+        # the rows that are left.
+        rows = uel_numpy.filter_rows(
+            filter_parsed,
+            env,
+            estimate=uel_numpy.stats_selectivity(dataset.stats),
+            indexes=indexes,
+            cancelled=cancelled,
+        )
+        data_col = evaluate(
+            [selection_parsed],
+            uel_numpy.narrow(env, selection_parsed, rows),
+            cancelled,
+        )[0]
+    else:
+        # selection and filter are compiled together so that
+        # subexpressions they have in common are only computed once.
+        results = evaluate([selection_parsed, filter_parsed], env, cancelled)
+        data_col = results[0]
+        if data_col is not None and results[1] is not None:
+            filter = results[1]
+            data_col = data_col[filter]
+            rows = np.arange(
+                len(dataset.df["lat"]) if visible is None else len(visible)
+            )
+            rows = rows[filter]
+    if visible is not None:
+        rows = visible if rows is None else visible[rows]
+    return data_col, rows
+
+
+def color_range(values):
+    values = np.asarray(values, dtype=np.float64)
+    if not np.isfinite(values).any():
+        return 0.0, 1.0
+    return float(np.nanmin(values)), float(np.nanmax(values))
+
+
+def raster_digest(selection_parsed, filter_parsed, cmin, cmax):
+    """
+    identifies the tiles of an optimized selection and filter colored from
+    cmin to cmax.
+    """
+    key = "\n".join(
+        [
+            uel.fingerprint(selection_parsed),
+            uel.fingerprint(filter_parsed),
+            repr(cmin),
+            repr(cmax),
+        ]
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def update_map(
+    dataset,
+    selection_parsed,
+    filter_parsed,
+    selection_error,
+    filter_error,
+    viewport=None,
+    cancelled=None,
+):
+    """
+    evaluates the selection and filter for the map, returning its points,
+    along with the selection and filter errors. the points are the
+    dataset's version, a pack_rows mask of which of its rows are shown, and
+    the color of each row that is, in row order. with more than
+    RASTER_POINTS rows shown, they're a raster_digest for map_tile instead.
+    cancelled is passed on to map_values.
+    """
+    data_col, rows = None, None
+    cmin, cmax = None, None
+    cache_key = None
+    length = len(dataset.df["lat"])
+
+    if selection_parsed is not None and selection_error == "" and filter_error == "":
+        # a plain variable is colored over its range in the whole dataset, so
+        # a color means the same thing whatever the filter.
+        selected = uel.unwrap(selection_parsed)
+        if isinstance(selected, uel.Ident) and selected.name in dataset.stats:
+            stats = dataset.stats[selected.name]
+            if stats.count > 0:
+                cmin, cmax = stats.min, stats.max
+
+        # fold unit conversions into the expressions, so that filters compare
+        # raw columns against converted constants.
+        selection_parsed, filter_parsed = uel.optimize(
+            [selection_parsed, filter_parsed], dataset.env, dataset.affine
+        )
+        # keyed by the optimized trees, so expressions that only differ in
+        # how they're written, or in constants that fold to the same value,
+        # share an entry.
+        cache_key = (
+            dataset.tsv_path,
+            dataset.version,
+            uel.fingerprint(selection_parsed),
+            uel.fingerprint(filter_parsed),
+            viewport,
+        )
+        cached = FIGURES.get(cache_key)
+        if cached is not None:
+            points_json, (selection_error, filter_error) = cached
+            return json.loads(points_json), selection_error, filter_error
+        try:
+            data_col, rows = map_values(
+                dataset, selection_parsed, filter_parsed, viewport, cancelled
+            )
+        except (KeyError, IndexError):
+            filter_error = "invalid filter"
+
+    points = {
+        "version": dataset.version,
+        "mask": None,
+        "colors": None,
+        "cmin": cmin,
+        "cmax": cmax,
+    }
+    if data_col is not None:
+        shown = length if rows is None else len(rows)
+        if RASTER_POINTS and shown > RASTER_POINTS and np.ndim(data_col):
+            if cmin is None:
+                cmin, cmax = color_range(data_col)
+                points.update(cmin=cmin, cmax=cmax)
+            points["raster"] = {
+                "digest": raster_digest(selection_parsed, filter_parsed, cmin, cmax)
+            }
+        else:
+            points["mask"] = pack_rows(rows, length)
+            points["colors"] = typedarrays.encode(data_col, BINARY_ARRAYS)
+    if cache_key is not None:
+        points_json = json.dumps(points)
+        FIGURES.put(cache_key, points_json, (selection_error, filter_error))
+    return points, selection_error, filter_error
+
+
+def tile_url(map_query, points):
+    """
+    the url template of the image of update_map's raster points, with
+    {scale}, {lon} and {lat} for climatemap.js to fill in with the map's
+    geo.projection.scale and geo.center. images are rendered by whichever
+    process gets them, so the url has everything needed to evaluate them
+    again.
+    """
+    return "/_tiles/%s/%s/%s/{scale}/{lon}/{lat}.png?%s" % (
+        map_query["dataset"],
+        points["version"],
+        points["raster"]["digest"],
+        urlencode(
+            {
+                "selection": map_query["selection"],
+                "filter": map_query["filter"],
+                "cmin": repr(points["cmin"]),
+                "cmax": repr(points["cmax"]),
+            }
+        ),
+    )
+
+
+def tile_grid(name, dataset, digest, selection_expr, filter_expr, cmin, cmax):
+    """
+    the tiles.Grid of the rows a selection and filter show in dataset, for
+    map_tile. None if the expressions don't evaluate to digest. they're
+    kept in TILES along with the images rendered from them, and don't hold
+    on to the dataset itself.
+    """
+    key = (name, dataset.version, digest)
+    cached = TILES.get(key)
+    if cached is not None:
+        return cached[0]
+    selection_parsed, filter_parsed, selection_error, filter_error = parse_expressions(
+        dataset, selection_expr, filter_expr
+    )
+    if selection_parsed is None or selection_error != "" or filter_error != "":
+        return None
+    selection_parsed, filter_parsed = uel.optimize(
+        [selection_parsed, filter_parsed], dataset.env, dataset.affine
+    )
+    if raster_digest(selection_parsed, filter_parsed, cmin, cmax) != digest:
+        return None
+    try:
+        data_col, rows = map_values(dataset, selection_parsed, filter_parsed)
+    except (KeyError, IndexError):
+        return None
+    if data_col is None or np.ndim(data_col) == 0:
+        return None
+    lat, lon = dataset.df["lat"].values, dataset.df["lon"].values
+    spacing = tiles.grid_spacing(lat)
+    if rows is not None:
+        lat, lon = lat[rows], lon[rows]
+    grid = tiles.Grid(lat, lon, np.asarray(data_col, dtype=np.float64), spacing)
+    TILES.put(key, grid, size=grid.nbytes)
+    return grid
 
 
 server = app.server
+
+
+@server.route("/_status/startup")
+def startup_status():
+    return flask.jsonify(dict(startup.report(), preload=PRELOAD))
+
+
+@server.route("/_tiles/<name>/<version>/<digest>/<scale>/<lon>/<lat>.png")
+def map_tile(name, version, digest, scale, lon, lat):
+    try:
+        view = float(scale), float(lon), float(lat)
+    except ValueError:
+        flask.abort(404)
+    if not (0 < view[0] <= 1024 and -180 <= view[1] <= 180 and -90 <= view[2] <= 90):
+        flask.abort(404)
+    cached = TILES.get((name, version, digest) + view)
+    served = version
+    if cached is None:
+        key = dataset_key(name)
+        args = flask.request.args
+        try:
+            cmin, cmax = float(args["cmin"]), float(args["cmax"])
+        except (KeyError, ValueError):
+            flask.abort(404)
+        if key not in DATASETS.paths:
+            flask.abort(404)
+        # this process may not have the version the url is for, if it's
+        # reloaded since, or not yet. the current version is the closest.
+        dataset = DATASETS.get(key, version)
+        served = dataset.version
+        cached = TILES.get((name, served, digest) + view)
+    if cached is not None:
+        image = cached[0]
+    else:
+        grid = tile_grid(
+            name,
+            dataset,
+            digest,
+            args.get("selection", ""),
+            args.get("filter", ""),
+            cmin,
+            cmax,
+        )
+        if grid is None:
+            flask.abort(404)
+        image = tiles.png(tiles.render(grid, cmin, cmax, view[0], view[1:]))
+        TILES.put((name, served, digest) + view, image)
+    response = flask.Response(image, mimetype="image/png")
+    if served == version:
+        # a tile's url names everything that goes into it
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@server.route("/_status/figures")
+def figures_status():
+    return flask.jsonify(
+        dict(FIGURES.stats(), tiles=TILES.stats(), dropped=QUERIES.dropped)
+    )
+
+
+startup.mark("layout")
+
+
+def load_default_dataset():
+    startup.record(DATASETS.get().timings)
+    startup.log_report()
+
+
+if PRELOAD:
+    load_default_dataset()
+else:
+    threading.Thread(target=load_default_dataset, daemon=True).start()
+
 if __name__ == "__main__":
     app.run_server(debug=True)
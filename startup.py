@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""
+how long each phase of starting the app took, for the startup report that's
+logged once the default dataset is loaded and served at /_status/startup.
+the first phase is timed from when this is imported, so import it first.
+"""
+
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+PHASES = collections.OrderedDict()
+last_mark = time.perf_counter()
+
+
+def mark(name):
+    """
+    records the time since the last mark as phase name.
+    """
+    global last_mark
+    now = time.perf_counter()
+    PHASES[name] = PHASES.get(name, 0.0) + now - last_mark
+    last_mark = now
+
+
+def record(timings):
+    """
+    records phases that were timed elsewhere, like a dataset's load.
+    """
+    for name, seconds in timings.items():
+        PHASES[name] = PHASES.get(name, 0.0) + seconds
+
+
+def report():
+    return {"phases": dict(PHASES), "total": sum(PHASES.values())}
+
+
+def log_report():
+    log.info(
+        "started in %.3fs: %s",
+        sum(PHASES.values()),
+        ", ".join("%s %.3fs" % phase for phase in PHASES.items()),
+    )
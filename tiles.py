@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+"""
+renders map points into a PNG of the view of plotly's geo_scope="usa" map,
+in the albers usa projection it's drawn in, so that the browser gets one
+image no matter how many points there are. plotly's geo maps have no tile
+layers, but an image laid over the whole plot area with sizing "contain"
+lines up with the map's frame, since plotly fits the frame into the plot
+area the same way. the points are put on a grid of their cells, and each
+pixel is colored like plotly colors markers, from the cell it shows.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+# the width in pixels of a view's image. its height follows from the frame.
+VIEW_WIDTH = 1024
+
+# grids with more cells than this are coarsened, to bound their memory
+MAX_CELLS = 2**24
+
+# plotly's default sequential colorscale (plasma), which Scattergeo markers
+# are colored with
+COLORSCALE = [
+    (0.0, "#0d0887"),
+    (0.1111111111111111, "#46039f"),
+    (0.2222222222222222, "#7201a8"),
+    (0.3333333333333333, "#9c179e"),
+    (0.4444444444444444, "#bd3786"),
+    (0.5555555555555556, "#d8576b"),
+    (0.6666666666666666, "#ed7953"),
+    (0.7777777777777778, "#fb9f3a"),
+    (0.8888888888888888, "#fdca26"),
+    (1.0, "#f0f921"),
+]
+
+# how opaque the colored pixels are, so the basemap shows through a little
+ALPHA = 210
+
+
+def colormap(colorscale=COLORSCALE, size=256):
+    """
+    a (size, 3) uint8 lookup table interpolated from colorscale.
+    """
+    stops = np.array([stop for stop, _ in colorscale])
+    rgb = np.array(
+        [[int(color[i : i + 2], 16) for i in (1, 3, 5)] for _, color in colorscale]
+    )
+    at = np.linspace(0, 1, size)
+    return (
+        np.stack(
+            [np.interp(at, stops, rgb[:, channel]) for channel in range(3)], axis=1
+        )
+        .round()
+        .astype(np.uint8)
+    )
+
+
+COLORMAP = colormap()
+
+
+def grid_spacing(lat):
+    """
+    the spacing in degrees of the grid the points lie on, taken as the most
+    common gap between neighbouring latitudes.
+    """
+    lat = np.unique(lat[~np.isnan(lat)])
+    gaps = np.diff(lat)
+    gaps = gaps[gaps > 1e-9]
+    if len(gaps) == 0:
+        return 0.0
+    values, counts = np.unique(gaps.round(6), return_counts=True)
+    return float(values[counts.argmax()])
+
+
+class ConicEqualArea:
+    """
+    d3's geoConicEqualArea, rotated by rotate degrees of longitude, with
+    center at the origin before scale and translate, like the parts of
+    d3.geoAlbersUsa. y grows downwards, as on screen. box is the
+    (x0, y0, x1, y1) of the projected plane it's clipped to.
+    """
+
+    def __init__(self, rotate, center, parallels, scale, translate, box):
+        self.rotate = np.radians(rotate)
+        sin0 = np.sin(np.radians(parallels[0]))
+        self.n = (sin0 + np.sin(np.radians(parallels[1]))) / 2
+        self.c = 1 + sin0 * (2 * self.n - sin0)
+        self.r0 = np.sqrt(self.c) / self.n
+        self.scale, self.translate, self.box = scale, translate, box
+        self.center = self.raw(*np.radians(center))
+
+    def raw(self, lam, phi):
+        r = np.sqrt(self.c - 2 * self.n * np.sin(phi)) / self.n
+        return r * np.sin(lam * self.n), self.r0 - r * np.cos(lam * self.n)
+
+    def forward(self, lon, lat):
+        lam = wrap(np.radians(lon) + self.rotate)
+        with np.errstate(invalid="ignore"):
+            x, y = self.raw(lam, np.radians(lat))
+        x = self.translate[0] + self.scale * (x - self.center[0])
+        y = self.translate[1] - self.scale * (y - self.center[1])
+        return x, y
+
+    def invert(self, x, y):
+        x = (x - self.translate[0]) / self.scale + self.center[0]
+        y = self.center[1] - (y - self.translate[1]) / self.scale
+        r0y = self.r0 - y
+        lam = np.arctan2(x, np.abs(r0y)) * np.sign(r0y)
+        lam -= np.where(r0y * self.n < 0, np.pi * np.sign(x) * np.sign(r0y), 0)
+        n2 = self.n * self.n
+        phi = np.arcsin(
+            np.clip((self.c - (x * x + r0y * r0y) * n2) / (2 * self.n), -1, 1)
+        )
+        return np.degrees(wrap(lam / self.n - self.rotate)), np.degrees(phi)
+
+    def inside(self, x, y):
+        x0, y0, x1, y1 = self.box
+        return (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+
+
+def wrap(lam):
+    return np.where(
+        lam > np.pi, lam - 2 * np.pi, np.where(lam < -np.pi, lam + 2 * np.pi, lam)
+    )
+
+
+# d3.geoAlbersUsa at scale 1 and translate 0: the lower 48 states, with
+# alaska and hawaii as insets. a point is drawn by the first of them whose
+# box it lands in.
+EPSILON = 1e-6
+LOWER48 = ConicEqualArea(
+    96, (-0.6, 38.7), (29.5, 45.5), 1, (0, 0), (-0.455, -0.238, 0.455, 0.238)
+)
+ALASKA = ConicEqualArea(
+    154,
+    (-2, 58.5),
+    (55, 65),
+    0.35,
+    (-0.307, 0.201),
+    (-0.425 + EPSILON, 0.120 + EPSILON, -0.214 - EPSILON, 0.234 - EPSILON),
+)
+HAWAII = ConicEqualArea(
+    157,
+    (-3, 19.9),
+    (8, 18),
+    1,
+    (-0.205, 0.212),
+    (-0.214 + EPSILON, 0.166 + EPSILON, -0.115 - EPSILON, 0.234 - EPSILON),
+)
+ALBERS_USA = (LOWER48, ALASKA, HAWAII)
+
+# the width and height of the map's frame, the lower 48's box, which
+# plotly fits into the plot area at projection.scale 1
+FRAME = (0.91, 0.476)
+
+# plotly's default geo.center for geo_scope="usa"
+DEFAULT_CENTER = (-96.6, 38.7)
+
+
+def albers_usa(lon, lat):
+    """
+    the projected x and y of each lon/lat, or NaN for those that aren't on
+    the map.
+    """
+    lon, lat = np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)
+    x, y = np.full(lon.shape, np.nan), np.full(lon.shape, np.nan)
+    left = np.ones(lon.shape, dtype=bool)
+    for part in ALBERS_USA:
+        px, py = part.forward(lon, lat)
+        drawn = left & part.inside(px, py)
+        x[drawn], y[drawn] = px[drawn], py[drawn]
+        left &= ~drawn
+    return x, y
+
+
+class Grid:
+    """
+    the mean value of the points in each cell of the grid they lie on, NaN
+    for cells without any, so a pixel's color is one lookup.
+    """
+
+    def __init__(self, lat, lon, values, spacing):
+        located = ~(np.isnan(lat) | np.isnan(lon) | np.isnan(values))
+        lat, lon, values = lat[located], lon[located], values[located]
+        self.spacing = spacing or 1.0
+        if len(lat) == 0:
+            self.lat0 = self.lon0 = 0.0
+            self.means = np.full((0, 0), np.nan)
+            return
+        self.lat0, self.lon0 = lat.min(), lon.min()
+        while True:
+            shape = (
+                int(np.rint((lat.max() - self.lat0) / self.spacing)) + 1,
+                int(np.rint((lon.max() - self.lon0) / self.spacing)) + 1,
+            )
+            if shape[0] * shape[1] <= MAX_CELLS:
+                break
+            self.spacing *= 2
+        cells = self.cells(lat, lon, shape)
+        size = shape[0] * shape[1]
+        sums = np.bincount(cells, weights=values, minlength=size)
+        counts = np.bincount(cells, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.means = np.where(counts > 0, sums / counts, np.nan).reshape(shape)
+
+    @property
+    def nbytes(self):
+        return self.means.nbytes
+
+    def cells(self, lat, lon, shape):
+        i = np.rint((lat - self.lat0) / self.spacing).astype(np.intp)
+        j = np.rint((lon - self.lon0) / self.spacing).astype(np.intp)
+        return i * shape[1] + j
+
+    def sample(self, lat, lon):
+        """
+        the value of the cell each lat/lon is in, or NaN.
+        """
+        height, width = self.means.shape
+        with np.errstate(invalid="ignore"):
+            i = np.rint((lat - self.lat0) / self.spacing)
+            j = np.rint((lon - self.lon0) / self.spacing)
+            inside = (i >= 0) & (i < height) & (j >= 0) & (j < width)
+        values = np.full(np.shape(lat), np.nan)
+        values[inside] = self.means[
+            i[inside].astype(np.intp), j[inside].astype(np.intp)
+        ]
+        return values
+
+
+def render(grid, cmin, cmax, scale=1.0, center=DEFAULT_CENTER, width=VIEW_WIDTH):
+    """
+    returns the view of grid at plotly's geo.projection.scale and
+    geo.center as an (height, width, 4) uint8 RGBA array, with values
+    colored from cmin to cmax and transparent pixels where there are no
+    points.
+    """
+    height = int(round(width * FRAME[1] / FRAME[0]))
+    cx, cy = albers_usa(np.array([center[0]]), np.array([center[1]]))
+    if np.isnan(cx[0]):
+        # panned off the map's parts, where only the lower 48 inverts
+        cx, cy = LOWER48.forward(np.array([center[0]]), np.array([center[1]]))
+    x = cx[0] + ((np.arange(width) + 0.5) / width - 0.5) * FRAME[0] / scale
+    y = cy[0] + ((np.arange(height) + 0.5) / height - 0.5) * FRAME[1] / scale
+    x, y = np.meshgrid(x, y)
+
+    # like d3's albersUsa.invert, the insets come first within their boxes,
+    # but only for points that wouldn't be drawn by one of the parts before
+    # them, and pixels they leave empty show the lower 48.
+    values = np.full(x.shape, np.nan)
+    for index in (1, 2, 0):
+        part = ALBERS_USA[index]
+        pixels = np.isnan(values) & part.inside(x, y)
+        lon, lat = part.invert(x[pixels], y[pixels])
+        sampled = grid.sample(lat, lon)
+        for before in ALBERS_USA[:index]:
+            sampled[before.inside(*before.forward(lon, lat))] = np.nan
+        values[pixels] = sampled
+
+    covered = ~np.isnan(values)
+    if cmax > cmin:
+        scaled = (np.where(covered, values, cmin) - cmin) / (cmax - cmin)
+    else:
+        scaled = np.full(values.shape, 0.5)
+    shades = np.clip(scaled * (len(COLORMAP) - 1), 0, len(COLORMAP) - 1)
+    image = np.zeros((height, width, 4), dtype=np.uint8)
+    image[..., :3] = COLORMAP[shades.round().astype(np.intp)]
+    image[..., 3] = np.where(covered, ALPHA, 0)
+    return image
+
+
+def png(image):
+    """
+    encodes an (height, width, 4) uint8 RGBA array as a PNG.
+    """
+    height, width, _ = image.shape
+
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    # every row starts with filter type 0, no filter
+    rows = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, width * 4)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+            chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+def run_tests():
+    # checked against d3.geoAlbersUsa().scale(1).translate([0, 0])
+    x, y = albers_usa(
+        [-96.6, -122.4194, -149.9, -157.8, -100], [38.7, 37.7749, 61.2, 21.3, 60]
+    )
+    expected = [
+        (0.0, 0.0),
+        (-0.34819915903570536, -0.03351112287481439),
+        (-0.28862502371579873, 0.18417064697068314),
+        (-0.1686919672513043, 0.18796143595605774),
+    ]
+    if not np.allclose(np.stack([x[:4], y[:4]], axis=1), expected, atol=1e-12):
+        raise Exception("bad projection %r" % list(zip(x, y)))
+    if not np.isnan(x[4]):
+        raise Exception("expected points off the map's parts not to be drawn")
+    for part, point in zip(ALBERS_USA, expected[1:]):
+        lon, lat = part.invert(*part.forward(*part.invert(*point)))
+        if not np.allclose(part.forward(lon, lat), point, atol=1e-12):
+            raise Exception("projection didn't round trip %r" % (point,))
+
+    lat = np.repeat(np.arange(25.0, 50.0, 0.25), 240)
+    lon = np.tile(np.arange(-125.0, -65.0, 0.25), 100)
+    values = lat.copy()
+    values[::7] = np.nan
+    if grid_spacing(lat) != 0.25:
+        raise Exception("bad grid spacing %r" % grid_spacing(lat))
+    grid = Grid(lat, lon, values, 0.25)
+    if grid.means.shape != (100, 240) or np.isnan(grid.sample(40.1, -99.9)):
+        raise Exception("bad grid %r" % (grid.means.shape,))
+
+    image = render(grid, 25.0, 50.0)
+    if image.shape != (536, VIEW_WIDTH, 4):
+        raise Exception("bad image shape %r" % (image.shape,))
+    covered = image[..., 3] > 0
+    if not 0.3 < covered.mean() < 0.9:
+        raise Exception("expected the points to cover part of the map")
+
+    def pixel(lon, lat, scale=1.0, center=DEFAULT_CENTER, image=image):
+        (x, cx), (y, cy) = albers_usa([lon, center[0]], [lat, center[1]])
+        height, width, _ = image.shape
+        col = int(width / 2 + (x - cx) * scale / FRAME[0] * width)
+        row = int(height / 2 + (y - cy) * scale / FRAME[1] * height)
+        return image[row, col]
+
+    north, south = pixel(-99.75, 40), pixel(-99.75, 30)
+    if not (north[3] and south[3]) or north[0] <= south[0]:
+        raise Exception("expected higher values to be brighter")
+    if pixel(-95, 50.5)[3] or pixel(-80, 24.6)[3]:
+        raise Exception("expected no color away from the points")
+
+    # zoomed in, each point covers its whole cell, so there are no gaps
+    # between them
+    zoomed = render(Grid(lat, lon, lat, 0.25), 25.0, 50.0, 8.0, (-100.0, 40.0))
+    if not (zoomed[..., 3] > 0).all():
+        raise Exception("expected the zoomed view to be covered")
+    zoomed = render(grid, 25.0, 50.0, 8.0, (-100.0, 40.0))
+    if pixel(-99.75, 40, 8.0, (-100.0, 40.0), zoomed)[0] != north[0]:
+        raise Exception("expected a point's color not to change with zoom")
+
+    lat, lon = np.meshgrid(np.arange(58.0, 66.0, 0.25), np.arange(-160.0, -140.0, 0.25))
+    alaska = Grid(lat.ravel(), lon.ravel(), lat.ravel(), 0.25)
+    if not pixel(-150, 61.1, image=render(alaska, 58.0, 66.0))[3]:
+        raise Exception("expected alaska to be drawn in its inset")
+
+    encoded = png(image)
+    if not encoded.startswith(b"\x89PNG") or len(encoded) > image.nbytes:
+        raise Exception("bad png")
+    width, height = struct.unpack(">II", encoded[16:24])
+    idat = encoded.index(b"IDAT")
+    (length,) = struct.unpack(">I", encoded[idat - 4 : idat])
+    raw = zlib.decompress(encoded[idat + 4 : idat + 4 + length])
+    decoded = np.frombuffer(raw, dtype=np.uint8).reshape(height, width * 4 + 1)
+    if not np.array_equal(decoded[:, 1:].reshape(image.shape), image):
+        raise Exception("png didn't round trip")
+
+
+if __name__ == "__main__":
+    run_tests()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+numeric arrays for callback responses, in a form json.dumps can write
+quickly. as JSON, each float64 takes about 18 bytes of decimal, and
+formatting it is most of the cost of serializing a response. binary arrays
+are sent as their little-endian bytes in base64 instead, about 5.3 bytes per
+float32, and assets/climatemap.js turns them into javascript typed arrays.
+"""
+
+import base64
+
+import numpy as np
+
+
+def storage_dtype(values):
+    """
+    the dtype values are sent as, which javascript has a typed array for:
+    uint8 for booleans, int32 for integers that fit it, float64 for those
+    that don't, and float32 for floats. None means values aren't numeric.
+    """
+    kind = values.dtype.kind
+    if kind == "b":
+        return np.dtype("uint8")
+    if kind in "iu":
+        info = np.iinfo(np.int32)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return np.dtype("int32")
+        return np.dtype("float64")
+    if kind == "f":
+        return np.dtype("float32")
+    return None
+
+
+def encode(values, binary=True):
+    """
+    returns values as something json.dumps can write. with binary, an array
+    is a dict of its dtype and its bytes in base64. otherwise it's a list,
+    with None for NaN, as JSON has no NaN. scalars and None are returned as
+    plain python values either way.
+    """
+    if values is None:
+        return None
+    if np.ndim(values) == 0:
+        value = np.asarray(values).item()
+        return None if value != value else value
+    values = np.asarray(values)
+    dtype = storage_dtype(values)
+    if dtype is None:
+        return values.tolist()
+    if binary:
+        data = np.ascontiguousarray(values, dtype=dtype.newbyteorder("<"))
+        return {
+            "dtype": dtype.name,
+            "bdata": base64.b64encode(data.tobytes()).decode("ascii"),
+        }
+    if values.dtype.kind == "f":
+        nan = np.isnan(values)
+        if nan.any():
+            values = values.astype(object)
+            values[nan] = None
+    return values.tolist()
+
+
+def decode(encoded):
+    """
+    the inverse of encode, for arrays.
+    """
+    if isinstance(encoded, dict):
+        dtype = np.dtype(encoded["dtype"]).newbyteorder("<")
+        return np.frombuffer(base64.b64decode(encoded["bdata"]), dtype=dtype)
+    return np.array(
+        [np.nan if value is None else value for value in encoded], dtype=float
+    )
+
+
+def run_tests():
+    import json
+
+    floats = np.array([1.5, np.nan, -2.25, 1e10])
+    for binary in (True, False):
+        decoded = decode(json.loads(json.dumps(encode(floats, binary))))
+        if not np.array_equal(decoded, floats.astype(np.float32), equal_nan=True):
+            raise Exception("bad round trip %r" % decoded)
+    if encode(np.array([True, False]))["dtype"] != "uint8":
+        raise Exception("expected booleans as uint8")
+    if encode(np.array([2**40, 1]))["dtype"] != "float64":
+        raise Exception("expected large integers as float64")
+    if decode(encode(np.array([7, -3]))).tolist() != [7, -3]:
+        raise Exception("bad round trip of integers")
+    if encode(np.float64(np.nan)) is not None or encode(np.int64(3)) != 3:
+        raise Exception("expected scalars as python values")
+    if encode(np.array(["a", "b"])) != ["a", "b"]:
+        raise Exception("expected other arrays as lists")
+
+
+if __name__ == "__main__":
+    run_tests()
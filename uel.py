@@ -5,7 +5,11 @@ the uncommon expression language. this is like CEL but instead of using
 protobufs it lets you use your own types kind of like userdata in lua.
 """
 
-import ast
+import collections
+import itertools
+import math
+import re
+import threading
 
 
 class ParserError(Exception):
@@ -17,259 +21,194 @@ class UnboundVariableError(Exception):
         return "Unknown variable: %s" % (self.args[0])
 
 
+class TypeCheckError(Exception):
+    def __str__(self):
+        return "Type error: %s" % (self.args[0])
+
+
 def assert_source(exception, message, line, col):
     raise exception("Error at line %d, column %d: %s" % (line, col, message))
 
 
-class Parser:
+# whitespace and comments are matched as a prefix of the token after them,
+# so the whole source is split by a single findall.
+TOKEN_RE = re.compile(
+    r"""
+    (?:[ \t\r\n]+ | \#[^\n]*)*
+    (?:
+        ([A-Za-z_][A-Za-z0-9_]*)
+      | ([0-9.][0-9_.]*)
+      | (&& | \|\| | <= | >= | == | != | ~= | <> | [-+*/^<>!()])
+      | (.)
+    )?
+""",
+    re.VERBOSE | re.DOTALL,
+)
 
-    IDENT_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789")
-    DISALLOWED_STARTING_IDENT_CHARS = set("0123456789.")
-    NUMBER_CHARS = set("0123456789_.")
+# keywords are case insensitive, so identifiers are lowercased to look them up
+KEYWORDS = set(["and", "or", "not"])
+
+
+def tokenize(source):
+    """
+    splits source into a list of (ident, number, op, error) tuples, where
+    exactly one of them is set, dropping whitespace and comments. the list
+    always ends with a tuple that has none of them set, for the end of input.
+    """
+    return TOKEN_RE.findall(source)
+
+
+class Parser:
+    """
+    an operator precedence parser. operators and pending parentheses are kept
+    on an explicit stack instead of the python call stack, so nesting depth
+    is only limited by memory, and no token is ever looked at twice. tokens
+    are the tuples straight out of tokenize, and lines and columns are only
+    worked out when there's an error to report.
+    """
 
     def __init__(self, io):
         if hasattr(io, "read"):
             self.source = io.read()
         else:
             self.source = io
-        self.pos = 0
-        self.line = 1
-        self.col = 1
-        self.current_char = self.source[:1]
-
-    def advance(self, distance=1):
-        for _ in range(distance):
-            assert not self.eof()
-            if self.current_char == "\n":
-                self.line += 1
-                self.col = 1
-            else:
-                self.col += 1
-            self.pos += 1
-            if self.pos >= len(self.source):
-                self.current_char = None
-            else:
-                self.current_char = self.source[self.pos]
-
-    def checkpoint(self):
-        return (self.pos, self.col, self.line)
+        self.tokens = tokenize(self.source)
 
-    def restore(self, checkpoint):
-        self.pos, self.col, self.line = checkpoint
-        if self.pos >= len(self.source):
-            self.current_char = None
-        else:
-            self.current_char = self.source[self.pos]
-
-    def source_ref(self, checkpoint):
-        return checkpoint[2], checkpoint[1]
-
-    def assert_source(self, message, line=None, col=None):
-        if line is None:
-            line = self.line
-        if col is None:
-            col = self.col
-        assert_source(ParserError, message, line, col)
-
-    def eof(self, lookahead=0):
-        assert lookahead >= 0
-        return self.pos + lookahead >= len(self.source)
-
-    def char(self, lookahead=0, required=False):
-        if self.pos + lookahead >= len(self.source) or self.pos + lookahead < 0:
-            if not required:
-                return None
-            assert lookahead >= 0
-            self.assert_source("end of input unexpected")
-        return self.source[self.pos + lookahead]
-
-    def string(self, width):
-        return self.source[self.pos : self.pos + width]
-
-    def skip_comment(self):
-        if self.current_char != "#":
-            return False
-        self.advance()
-        while True:
-            if self.eof():
-                return True
-            self.advance()
-            if self.current_char == "\n":
-                return True
-
-    def skip_whitespace(self):
-        if self.eof():
-            return False
-        if self.skip_comment():
-            return True
-        if self.current_char in " \t\r\n":
-            self.advance()
-            return True
-        return False
-
-    def skip_all_whitespace(self):
-        any_skipped = False
-        while self.skip_whitespace():
-            any_skipped = True
-        return any_skipped
-
-    def parse_identifier(self):
-        if self.current_char in self.DISALLOWED_STARTING_IDENT_CHARS:
-            return None
-        chars = self.parse_chars(self.IDENT_CHARS)
-        if chars is None:
-            return None
-        return Ident(chars)
+    def position(self, index):
+        # the same match again, this time with where it ended
+        match = next(itertools.islice(TOKEN_RE.finditer(self.source), index, None))
+        offset = match.end() - len("".join(match.groups("")))
+        line = self.source.count("\n", 0, offset) + 1
+        return line, offset - self.source.rfind("\n", 0, offset)
 
-    def parse_value(self):
-        nums = self.parse_chars(self.NUMBER_CHARS)
-        if nums is None:
-            return None
-        return Value(ast.literal_eval(nums))
+    def assert_source(self, message, index):
+        assert_source(ParserError, message, *self.position(index))
 
-    def parse_chars(self, allowed):
-        if self.current_char not in allowed:
-            return None
-        chars = self.current_char
-        self.advance()
-        while self.current_char in allowed:
-            chars += self.current_char
-            self.advance()
-        self.skip_all_whitespace()
-        return chars
-
-    def parse_literal(self):
-        var = self.parse_identifier()
-        if var is not None:
-            return var
-        return self.parse_value()
-
-    def parse_subexpression(self):
-        if self.char() != "(":
-            return self.parse_literal()
-        self.advance()
-        expr = self.parse_expression()
-        self.skip_all_whitespace()
-        if self.char() != ")":
-            self.assert_source(
-                "subexpression ended unexpectedly, found %r" % self.char()
-            )
-        self.advance()
-        self.skip_all_whitespace()
-        return Subexpression(expr)
-
-    def parse_exponentiation(self):
-        return self.parse_operation(
-            self.parse_subexpression,
-            {
-                OpExp: ["^"],
-            },
-        )
+    def parse(self):
+        # ops holds (precedence, node class, is_prefix) entries, with
+        # parentheses as PAREN markers that nothing reduces past.
+        operands, ops = [], []
+        push, pop, push_op = operands.append, operands.pop, ops.append
+        binary_ops, prefix_ops = BINARY_OPS, PREFIX_OPS
+        open_parens = 0
+        min_prefix = 1
+        want_value = True
+
+        for index, (ident, number, op, error) in enumerate(self.tokens):
+            if ident and ident.lower() in KEYWORDS:
+                ident, op = "", ident.lower()
+            if want_value:
+                if ident:
+                    push(Ident(ident))
+                    want_value = False
+                elif number:
+                    try:
+                        value = float(number) if "." in number else int(number)
+                    except ValueError:
+                        self.assert_source("invalid number %r" % number, index)
+                    push(Value(value))
+                    want_value = False
+                elif op == "(":
+                    push_op(PAREN)
+                    open_parens += 1
+                    min_prefix = 1
+                else:
+                    prefix = prefix_ops.get(op)
+                    if prefix is None or prefix[0] < min_prefix:
+                        if error:
+                            self.assert_source("unexpected character %r" % error, index)
+                        if op:
+                            self.assert_source("expected a value, found %r" % op, index)
+                        if index == 0:
+                            return None
+                        self.assert_source("end of input unexpected", index)
+                    push_op(prefix)
+                    min_prefix = prefix[0] + 1
+                continue
+
+            binary = binary_ops.get(op)
+            if binary is not None:
+                precedence = binary[0]
+                if ops and ops[-1][0] >= precedence:
+                    self.reduce(operands, ops, precedence)
+                push_op(binary)
+                min_prefix = precedence + 1
+                want_value = True
+                continue
+            if op == ")" and open_parens > 0:
+                self.reduce(operands, ops, 1)
+                ops.pop()
+                open_parens -= 1
+                push(Subexpression(pop()))
+                continue
+            if error:
+                self.assert_source("unexpected character %r" % error, index)
+            if open_parens > 0:
+                self.assert_source(
+                    "subexpression ended unexpectedly, found %r"
+                    % (ident or number or op or None),
+                    index,
+                )
+            if ident or number or op:
+                self.assert_source("unparsed input", index)
+            self.reduce(operands, ops, 1)
+            return pop()
+
+    def reduce(self, operands, ops, precedence):
+        # everything here is left associative, so equal precedence reduces too
+        while ops and ops[-1][0] >= precedence:
+            _, cls, is_prefix = ops.pop()
+            if is_prefix:
+                operands.append(cls(operands.pop()))
+            else:
+                rhs = operands.pop()
+                operands.append(cls(operands.pop(), rhs))
 
-    def parse_val_negation(self):
-        return self.parse_modifier(self.parse_exponentiation, {ModNeg: ["-"]})
 
-    def parse_multiplication_division(self):
-        return self.parse_operation(
-            self.parse_val_negation,
-            {
-                OpMul: ["*"],
-                OpDiv: ["/"],
-            },
-        )
+class Node:
+    """
+    parsed expressions are shared between callers through PARSE_CACHE, so a
+    node can't be changed once it's built. constructors fill in their slots
+    with init_slot.
+    """
 
-    def parse_addition_subtraction(self):
-        return self.parse_operation(
-            self.parse_multiplication_division,
-            {
-                OpAdd: ["+"],
-                OpSub: ["-"],
-            },
-        )
+    __slots__ = ()
 
-    def parse_comparison(self):
-        return self.parse_operation(
-            self.parse_addition_subtraction,
-            {
-                OpLess: ["<"],
-                OpLessEqual: ["<="],
-                OpEqual: ["=="],
-                OpNotEqual: ["!=", "~=", "<>"],
-                OpGreater: [">"],
-                OpGreaterEqual: [">="],
-            },
-        )
+    def __setattr__(self, name, value):
+        raise AttributeError("%s nodes are immutable" % type(self).__name__)
 
-    def parse_bool_negation(self):
-        return self.parse_modifier(self.parse_comparison, {ModNot: ["!", "not"]})
+    def __delattr__(self, name):
+        raise AttributeError("%s nodes are immutable" % type(self).__name__)
 
-    def parse_conjunction(self):
-        return self.parse_operation(self.parse_bool_negation, {OpAnd: ["&&", "and"]})
 
-    def parse_disjunction(self):
-        return self.parse_operation(self.parse_conjunction, {OpOr: ["||", "or"]})
+# sets one of a node's slots, going around Node.__setattr__, so it's only for
+# constructors. this is object.__setattr__ itself rather than a wrapper, since
+# a python level call per slot costs the parser about 15%.
+init_slot = object.__setattr__
 
-    def parse_operation(self, value_parse, op_map):
-        val = value_parse()
-        while True:
-            if self.eof():
-                return val
-            cls, rhs = self.parse_op_and_rhs(value_parse, op_map)
-            if cls is None:
-                break
-            val = cls(val, rhs)
-        return val
 
-    def parse_modifier(self, value_parse, mod_map):
-        cls, val = self.parse_op_and_rhs(value_parse, mod_map)
-        if cls is not None:
-            return cls(val)
-        return value_parse()
-
-    def is_boundary(self, char1, char2):
-        return char1 not in self.IDENT_CHARS or char2 not in self.IDENT_CHARS
-
-    def parse_op_and_rhs(self, value_parse, op_map):
-        checkpoint = self.checkpoint()
-        for cls, operators in op_map.items():
-            for op in operators:
-                if self.string(len(op)).lower() == op and self.is_boundary(
-                    self.char(len(op) - 1), self.char(len(op))
-                ):
-                    self.advance(len(op))
-                    self.skip_all_whitespace()
-                    rhs = value_parse()
-                    if rhs is not None:
-                        return cls, rhs
-                    self.restore(checkpoint)
-        return None, None
+class Subexpression(Node):
+    __slots__ = ("expr",)
 
-    def parse(self):
-        self.skip_all_whitespace()
-        val = self.parse_expression()
-        if not self.eof():
-            self.assert_source("unparsed input")
-        return val
-
-    def parse_expression(self):
-        return self.parse_disjunction()
-
-
-class Subexpression:
     def __init__(self, expr):
-        self.expr = expr
+        init_slot(self, "expr", expr)
 
     def __repr__(self):
         return "(%r)" % self.expr
 
+    def children(self):
+        return (self.expr,)
+
     def run(self, env):
         return self.expr.run(env)
 
 
-class Operation:
+class Operation(Node):
+    __slots__ = ("lhs", "rhs")
+
     def __init__(self, lhs, rhs):
-        self.lhs = lhs
-        self.rhs = rhs
+        init_slot(self, "lhs", lhs)
+        init_slot(self, "rhs", rhs)
 
     def __repr__(self):
         return "%r %s %r" % (self.lhs, self.op, self.rhs)
@@ -279,6 +218,45 @@ class Operation:
             self.lhs.run(env), self.rhs.run(env)
         )
 
+    def children(self):
+        return (self.lhs, self.rhs)
+
+    def chain(self, compiler):
+        # a left-leaning chain like a + b - c * d < e is folded into one loop
+        # over (operator, rhs) steps instead of one nested closure per node.
+        # the chain stops at subtrees that are shared, so they're still only
+        # computed once.
+        links = []
+        node = self
+        while True:
+            links.append(node)
+            node = unwrap(node.lhs)
+            if not isinstance(node, Operation) or compiler.is_shared(node):
+                break
+        links.reverse()
+        return node, links
+
+    def inputs(self, compiler):
+        first, links = self.chain(compiler)
+        return [first] + [link.rhs for link in links]
+
+    def compile(self, compiler, fns):
+        _, links = self.chain(compiler)
+        first = fns[0]
+        steps = [(compiler.op(type(link)), fn) for link, fn in zip(links, fns[1:])]
+
+        if len(steps) == 1:
+            op, rhs = steps[0]
+            return lambda env, memo: op(first(env, memo), rhs(env, memo))
+
+        def run_chain(env, memo):
+            val = first(env, memo)
+            for op, rhs in steps:
+                val = op(val, rhs(env, memo))
+            return val
+
+        return run_chain
+
 
 class OpOr(Operation):
     op = "or"
@@ -332,9 +310,11 @@ class OpExp(Operation):
     op = "^"
 
 
-class Modifier:
+class Modifier(Node):
+    __slots__ = ("val",)
+
     def __init__(self, val):
-        self.val = val
+        init_slot(self, "val", val)
 
     def __repr__(self):
         return "%r %r" % (self.op, self.val)
@@ -342,6 +322,17 @@ class Modifier:
     def run(self, env):
         return (env.get(type(self)) or DEFAULT_ENV.get(type(self)))(self.val.run(env))
 
+    def children(self):
+        return (self.val,)
+
+    def inputs(self, compiler):
+        return (self.val,)
+
+    def compile(self, compiler, fns):
+        op = compiler.op(type(self))
+        val = fns[0]
+        return lambda env, memo: op(val(env, memo))
+
 
 class ModNot(Modifier):
     op = "not"
@@ -370,9 +361,299 @@ DEFAULT_ENV = {
 }
 
 
-class Ident:
+def resolve_op(env, cls):
+    return env.get(cls) or DEFAULT_ENV.get(cls)
+
+
+def unwrap(expr):
+    while isinstance(expr, Subexpression):
+        expr = expr.expr
+    return expr
+
+
+# a < b is b > a, and so on
+FLIPPED_COMPARISONS = {
+    OpLess: OpGreater,
+    OpLessEqual: OpGreaterEqual,
+    OpEqual: OpEqual,
+    OpNotEqual: OpNotEqual,
+    OpGreater: OpLess,
+    OpGreaterEqual: OpLessEqual,
+}
+
+
+class Optimizer:
+    """
+    folds constant subtrees into Values and hash-conses everything else, so
+    structurally identical subtrees come back as the very same node. one
+    Optimizer can be used for several expressions that are evaluated
+    together, so they share subtrees with each other too.
+
+    affine maps variable names to (name, scale, offset), for variables that
+    are stored as another variable in different units. those are expanded
+    to name * scale + offset, except that comparisons against a constant
+    convert the constant instead, so no converted values are computed. the
+    two can only disagree about values within rounding error of the
+    constant.
+    """
+
+    def __init__(self, env, affine=None):
+        self.env = env
+        self.affine = affine or {}
+        self.nodes = {}
+        # id of an expansion -> (Ident, scale, offset)
+        self.expansions = {}
+
+    def optimize(self, expr):
+        # post-order over an explicit stack, since parsed trees can be much
+        # deeper than the python recursion limit.
+        done = {}
+        stack = [(expr, False)]
+        while stack:
+            node, ready = stack.pop()
+            if id(node) in done:
+                continue
+            if not ready:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children())
+                continue
+            done[id(node)] = self.canonical(
+                node, [done[id(child)] for child in node.children()]
+            )
+        return done[id(expr)]
+
+    def canonical(self, node, children):
+        cls = type(node)
+        if cls is Ident:
+            if node.name in self.affine:
+                return self.expand(*self.affine[node.name])
+            key = (cls, node.name)
+        elif cls is Value:
+            key = (cls, type(node.val), node.val)
+            if key[1] is float and node.val == 0:
+                # 0.0 == -0.0, but 1 / -0.0 is -inf
+                key += (math.copysign(1, node.val),)
+        elif cls is Subexpression:
+            if isinstance(children[0], (Ident, Value, Subexpression)):
+                return children[0]
+            key = (cls, id(children[0]))
+        else:
+            if all(isinstance(unwrap(child), Value) for child in children):
+                try:
+                    node = Value(
+                        resolve_op(self.env, cls)(
+                            *[unwrap(child).val for child in children]
+                        )
+                    )
+                except ArithmeticError:
+                    # leave it for evaluation time to complain about
+                    pass
+                else:
+                    return self.canonical(node, ())
+            if cls in FLIPPED_COMPARISONS:
+                folded = self.fold_comparison(cls, *children)
+                if folded is not None:
+                    return folded
+            key = (cls,) + tuple(id(child) for child in children)
+        existing = self.nodes.get(key)
+        if existing is None:
+            if children:
+                node = cls(*children)
+            existing = self.nodes[key] = node
+        return existing
+
+    def make(self, cls, *children):
+        return self.canonical(cls(*children), children)
+
+    def expand(self, name, scale, offset):
+        ident = self.canonical(Ident(name), ())
+        expr = ident
+        if scale != 1:
+            expr = self.make(OpMul, expr, self.canonical(Value(scale), ()))
+        if offset != 0:
+            expr = self.make(OpAdd, expr, self.canonical(Value(offset), ()))
+        self.expansions[id(expr)] = (ident, scale, offset)
+        return expr
+
+    def fold_comparison(self, cls, lhs, rhs):
+        lhs, rhs = unwrap(lhs), unwrap(rhs)
+        if id(lhs) not in self.expansions:
+            cls, lhs, rhs = FLIPPED_COMPARISONS[cls], rhs, lhs
+        if id(lhs) not in self.expansions or not isinstance(rhs, Value):
+            return None
+        ident, scale, offset = self.expansions[id(lhs)]
+        if scale < 0:
+            cls = FLIPPED_COMPARISONS[cls]
+        value = self.canonical(Value((rhs.val - offset) / scale), ())
+        return self.make(cls, ident, value)
+
+
+def optimize(exprs, env, affine=None):
+    optimizer = Optimizer(env, affine)
+    return [expr and optimizer.optimize(expr) for expr in exprs]
+
+
+# compiled closures call each other, so a deep tree would make for a deep
+# python stack when it runs. anything nested more deeply than this is
+# spilled instead, see Compiler.
+MAX_DEPTH = 100
+
+
+class Compiler:
+    """
+    builds closures of the form fn(env, memo). nodes that are reachable more
+    than once from the expressions being compiled store their result in memo,
+    a dict that lives for a single evaluation.
+
+    closures are built bottom up over an explicit stack. a node whose
+    closure would end up more than MAX_DEPTH calls deep is spilled: it goes
+    on the spills list of (slot, fn) pairs, which run_all evaluates into
+    memo in order before anything else, and whatever uses it just reads the
+    slot. spills are listed children first, so nothing running from the
+    list or from the top is ever more than MAX_DEPTH calls deep.
+    """
+
+    def __init__(self, env, exprs):
+        self.env = env
+        self.shared = set()
+        self.compiled = {}
+        self.depths = {}
+        self.slots = 0
+        self.spills = []
+        seen = set()
+        stack = [expr for expr in exprs if expr is not None]
+        while stack:
+            node = unwrap(stack.pop())
+            if id(node) in seen:
+                if node.children():
+                    self.shared.add(id(node))
+                continue
+            seen.add(id(node))
+            stack.extend(node.children())
+
+    def op(self, cls):
+        return resolve_op(self.env, cls)
+
+    def is_shared(self, node):
+        return id(node) in self.shared
+
+    def compile(self, expr):
+        root = unwrap(expr)
+        stack = [(root, False)]
+        while stack:
+            node, ready = stack.pop()
+            if id(node) in self.compiled:
+                continue
+            inputs = [unwrap(child) for child in node.inputs(self)]
+            if not ready:
+                stack.append((node, True))
+                stack.extend((child, False) for child in inputs)
+                continue
+            fn = node.compile(self, [self.compiled[id(child)] for child in inputs])
+            depth = 1 + max([self.depths[id(child)] for child in inputs] or [0])
+            if depth > MAX_DEPTH:
+                self.spills.append((self.slots, fn))
+                fn, depth = recall(self.slots), 1
+                self.slots += 1
+            elif id(node) in self.shared:
+                fn, depth = memoize(fn, self.slots), depth + 1
+                self.slots += 1
+            self.compiled[id(node)] = fn
+            self.depths[id(node)] = depth
+        return self.compiled[id(root)]
+
+    def run_spills(self, env, memo):
+        for slot, fn in self.spills:
+            memo[slot] = fn(env, memo)
+
+
+def memoize(fn, slot):
+    def shared(env, memo):
+        if slot in memo:
+            return memo[slot]
+        val = memo[slot] = fn(env, memo)
+        return val
+
+    return shared
+
+
+def recall(slot):
+    return lambda env, memo: memo[slot]
+
+
+def compile_all(exprs, env):
+    """
+    turns parsed expressions into a single python callable that evaluates
+    all of them against an env and returns their values as a list (None for
+    an empty expression). the
+    expressions are optimized first, so constant subtrees are computed here
+    and any subtree they have in common is computed once per call. operator
+    implementations are looked up in env once, here, so the returned function
+    only has to look up variables when it is called.
+    """
+    exprs = optimize(exprs, env)
+    compiler = Compiler(env, exprs)
+    fns = [
+        compiler.compile(expr) if expr is not None else lambda env, memo: None
+        for expr in exprs
+    ]
+    run_spills = compiler.run_spills
+
+    def run_all(env):
+        memo = {}
+        run_spills(env, memo)
+        return [fn(env, memo) for fn in fns]
+
+    return run_all
+
+
+def compile(expr, env):
+    """
+    like compile_all, for a single expression.
+    """
+    run_all = compile_all([expr], env)
+    return lambda env: run_all(env)[0]
+
+
+# binding strength of each operator, loosest first, as the (precedence, node
+# class, is_prefix) entries the parser stacks. a prefix operator applies to
+# everything after it that binds more tightly than it does, and may only
+# appear where an operand at least as loose is allowed, so e.g. "not not x",
+# "- -x" and "2 ^ -1" are rejected.
+BINARY_OPS = {
+    "or": (1, OpOr, False),
+    "||": (1, OpOr, False),
+    "and": (2, OpAnd, False),
+    "&&": (2, OpAnd, False),
+    "<": (4, OpLess, False),
+    "<=": (4, OpLessEqual, False),
+    "==": (4, OpEqual, False),
+    "!=": (4, OpNotEqual, False),
+    "~=": (4, OpNotEqual, False),
+    "<>": (4, OpNotEqual, False),
+    ">": (4, OpGreater, False),
+    ">=": (4, OpGreaterEqual, False),
+    "+": (5, OpAdd, False),
+    "-": (5, OpSub, False),
+    "*": (6, OpMul, False),
+    "/": (6, OpDiv, False),
+    "^": (8, OpExp, False),
+}
+
+PREFIX_OPS = {
+    "not": (3, ModNot, True),
+    "!": (3, ModNot, True),
+    "-": (7, ModNeg, True),
+}
+
+PAREN = (0, None, False)
+
+
+class Ident(Node):
+    __slots__ = ("name",)
+
     def __init__(self, name):
-        self.name = name
+        init_slot(self, "name", name)
 
     def __repr__(self):
         return self.name
@@ -382,10 +663,28 @@ class Ident:
             raise UnboundVariableError("%r" % self.name)
         return env[self.name]
 
+    def children(self):
+        return ()
+
+    def inputs(self, compiler):
+        return ()
+
+    def compile(self, compiler, fns):
+        name = self.name
+
+        def lookup(env, memo):
+            if name not in env:
+                raise UnboundVariableError("%r" % name)
+            return env[name]
+
+        return lookup
+
+
+class Value(Node):
+    __slots__ = ("val",)
 
-class Value:
     def __init__(self, val):
-        self.val = val
+        init_slot(self, "val", val)
 
     def __repr__(self):
         return repr(self.val)
@@ -393,6 +692,196 @@ class Value:
     def run(self, env):
         return self.val
 
+    def children(self):
+        return ()
+
+    def inputs(self, compiler):
+        return ()
+
+    def compile(self, compiler, fns):
+        val = self.val
+        return lambda env, memo: val
+
+
+def fingerprint(expr):
+    """
+    returns a string that two expressions share exactly when their trees are
+    the same, whatever parentheses, whitespace and comments they were
+    written with. it's the tree in prefix order, which needs no parentheses
+    since every node's class fixes how many children it has.
+    """
+    parts = []
+    stack = [expr]
+    while stack:
+        node = unwrap(stack.pop())
+        if node is None:
+            parts.append("None")
+        elif isinstance(node, Ident):
+            parts.append("$" + node.name)
+        elif isinstance(node, Value):
+            parts.append(repr(node.val))
+        else:
+            parts.append(type(node).__name__)
+            stack.extend(reversed(node.children()))
+    return " ".join(parts)
+
+
+def identifiers(expr):
+    """
+    returns the set of variable names expr refers to.
+    """
+    names = set()
+    stack = [expr] if expr is not None else []
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Ident):
+            names.add(node.name)
+        else:
+            stack.extend(node.children())
+    return names
+
+
+NUMBER = "number"
+BOOLEAN = "true/false"
+
+
+class Symbol:
+    """
+    what check knows about a variable without looking at its value.
+    """
+
+    def __init__(self, kind, dtype=None, units=None):
+        self.kind = kind
+        self.dtype = dtype
+        self.units = units
+
+    def __repr__(self):
+        return "Symbol(%r, dtype=%r, units=%r)" % (self.kind, self.dtype, self.units)
+
+
+ARITHMETIC_OPS = (OpAdd, OpSub, OpMul, OpDiv, OpExp, ModNeg)
+ORDERING_OPS = (OpLess, OpLessEqual, OpGreater, OpGreaterEqual)
+EQUALITY_OPS = (OpEqual, OpNotEqual)
+LOGICAL_OPS = (OpAnd, OpOr, ModNot)
+
+
+def check(expr, symbols, expected=None):
+    """
+    statically checks expr against symbols, a map of variable names to
+    Symbols, and returns the kind of value it would evaluate to (NUMBER or
+    BOOLEAN), or None for an empty expression. raises UnboundVariableError
+    for unknown names and TypeCheckError for values used where they don't
+    make sense, including a result that isn't of the expected kind.
+    """
+    if expr is None:
+        return None
+    kinds = {}
+    stack = [(expr, False)]
+    while stack:
+        node, ready = stack.pop()
+        node = unwrap(node)
+        if id(node) in kinds:
+            continue
+        if isinstance(node, Value):
+            kinds[id(node)] = BOOLEAN if isinstance(node.val, bool) else NUMBER
+            continue
+        if isinstance(node, Ident):
+            if node.name not in symbols:
+                raise UnboundVariableError("%r" % node.name)
+            kinds[id(node)] = symbols[node.name].kind
+            continue
+        children = [unwrap(child) for child in node.children()]
+        if not ready:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children)
+            continue
+
+        if isinstance(node, EQUALITY_OPS):
+            if kinds[id(children[0])] != kinds[id(children[1])]:
+                raise TypeCheckError(
+                    "%r compares a %s with a %s"
+                    % (
+                        node,
+                        kinds[id(children[0])],
+                        kinds[id(children[1])],
+                    )
+                )
+            kinds[id(node)] = BOOLEAN
+            continue
+        if isinstance(node, LOGICAL_OPS):
+            needs, kind = BOOLEAN, BOOLEAN
+        elif isinstance(node, ORDERING_OPS):
+            needs, kind = NUMBER, BOOLEAN
+        else:
+            needs, kind = NUMBER, NUMBER
+        for child in children:
+            if kinds[id(child)] != needs:
+                raise TypeCheckError(
+                    "%r needs %s values, but %r is a %s"
+                    % (node.op, needs, child, kinds[id(child)])
+                )
+        kinds[id(node)] = kind
+
+    kind = kinds[id(unwrap(expr))]
+    if expected is not None and kind != expected:
+        raise TypeCheckError("expected a %s expression, got a %s" % (expected, kind))
+    return kind
+
+
+class ParseCache:
+    """
+    a bounded, thread-safe LRU map from (parser kind, source text) to the
+    parsed expression. parse errors are remembered too, so a half-typed
+    expression isn't reparsed by every caller that looks at it.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, parse):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            try:
+                entry = (parse(), None)
+            except ParserError as e:
+                entry = (None, e)
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        tree, error = entry
+        if error is not None:
+            raise type(error)(*error.args)
+        return tree
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+            }
+
+
+PARSE_CACHE = ParseCache()
+
 
 def run_tests():
     def check_result(input, env, expected):
@@ -429,14 +918,291 @@ def run_tests():
     check_result("1 + (10 / 2) ", {}, 6)
     check_result("1 + (10 / 2) > 3", {}, True)
 
+    def check_compiled(input, env):
+        expected = uel_parse(input).run(env)
+        val = uel_compile(input, env)(env)
+        if val != expected:
+            raise Exception(
+                "input %r with env %r compiled to %r, interpreted to %r"
+                % (input, env, val, expected)
+            )
+
+    check_compiled("1 + 2 * 3 - 4 / 5", {})
+    check_compiled("((1 - 2) - 3) - (4 - 5)", {})
+    check_compiled("-x ^ 2 + y", {"x": 3, "y": 1})
+    check_compiled("not (x < 2) and (y >= 1 or x == 3)", {"x": 3, "y": 0})
+    check_compiled("x * 9 / 5 + 32 > 95", {"x": 36})
+    check_compiled(" + ".join(["x"] * 500), {"x": 2})
+
+    def check_tree(input, expected):
+        tree = repr(uel_parse(input))
+        if tree != expected:
+            raise Exception(
+                "input %r parsed to %r, expected %r" % (input, tree, expected)
+            )
+
+    check_tree("-x ^ 2 * 3", "'-' x ^ 2 * 3")
+    check_tree("not a < 1 and b or c", "'not' a < 1 and b or c")
+    check_tree("1 - 2 - 3", "1 - 2 - 3")
+    check_tree("1 - (2 - 3)", "1 - (2 - 3)")
+    check_tree("a or b and c", "a or b and c")
+    if not isinstance(uel_parse("a or b and c").rhs, OpAnd):
+        raise Exception("expected and to bind more tightly than or")
+    if not isinstance(uel_parse("-x ^ 2").val, OpExp):
+        raise Exception("expected ^ to bind more tightly than negation")
+    if uel_parse("") is not None or uel_parse("  # nothing\n") is not None:
+        raise Exception("expected an empty expression to parse to None")
+
+    depth = 5000
+    check_result("(" * depth + "x" + ")" * depth, {"x": 7}, 7)
+    check_result(" - ".join(["x"] * depth), {"x": 1}, 2 - depth)
+    check_result("x + (" * depth + "x" + ")" * depth, {"x": 1}, depth + 1)
+    check_result("-(" * depth + "x" + ")" * depth, {"x": 3}, 3)
+    check_result("x * y - (" * depth + "x" + ")" * depth, {"x": 1, "y": 2}, 1)
+    # deep enough to spill, shallow enough for the interpreter to check
+    check_compiled("(" + "x - (" * 150 + "y" + ")" * 151 + " * 2", {"x": 5, "y": 1})
+    tree = uel_parse("1 + (" * depth + "1" + ")" * depth)
+    for _ in range(depth):
+        tree = tree.rhs.expr
+    if tree.val != 1:
+        raise Exception("deeply nested expression parsed incorrectly")
+
+    try:
+        uel_compile("x + 1", {})({})
+    except UnboundVariableError:
+        pass
+    else:
+        raise Exception("expected unbound variable error")
+
+    # operators are bound when compiling, not when running
+    env = {OpAdd: lambda a, b: a * b}
+    fn = uel_compile("2 + 5", env)
+    env[OpAdd] = lambda a, b: a - b
+    if fn({}) != 10:
+        raise Exception("compiled expression did not bind operators up front")
+
+    def check_error(input, expected):
+        try:
+            uel_parse(input)
+        except ParserError as e:
+            if str(e) != expected:
+                raise Exception(
+                    "input %r: expected %r, got %r" % (input, expected, str(e))
+                )
+        else:
+            raise Exception("input %r: expected error %r" % (input, expected))
+
+    check_result("X AND NOT y", {"X": True, "y": False}, True)
+    check_result("1 <> 2 && 2 ~= 3", {}, True)
+    check_result("1_0 + .5", {}, 10.5)
+    check_result("notable or android", {"notable": False, "android": True}, True)
+    check_error("1 + + 2", "Error at line 1, column 5: expected a value, found '+'")
+    check_error("1 2", "Error at line 1, column 3: unparsed input")
+    check_error("x and", "Error at line 1, column 6: end of input unexpected")
+    check_error("(1 + 2))", "Error at line 1, column 8: unparsed input")
+    check_error("not not x", "Error at line 1, column 5: expected a value, found 'not'")
+    check_error("- -x", "Error at line 1, column 3: expected a value, found '-'")
+    check_error("2 ^ -1", "Error at line 1, column 5: expected a value, found '-'")
+    check_error("1 < not x", "Error at line 1, column 5: expected a value, found 'not'")
+    check_error("()", "Error at line 1, column 2: expected a value, found ')'")
+    check_error(
+        "1 +\n  # hi\n  $", "Error at line 3, column 3: unexpected character '$'"
+    )
+    check_error(
+        "(1 +\n 2",
+        "Error at line 2, column 3: subexpression ended unexpectedly, found None",
+    )
+    check_error("x < 1.2.3", "Error at line 1, column 5: invalid number '1.2.3'")
+
+    folded = optimize([uel_parse("x * (9 / 5 * 3) + -(2 ^ 2)")], {})[0]
+    if repr(folded) != "x * 5.4 + -4":
+        raise Exception("expected constants to be folded, got %r" % folded)
+
+    def ieee_div(a, b):
+        if b == 0:
+            return math.copysign(math.inf, a) * math.copysign(1, b)
+        return a / b
+
+    env = {OpDiv: ieee_div}
+    folded = optimize([uel_parse("1 / 0.0"), uel_parse("1 / -0.0")], env)
+    if [expr.val for expr in folded] != [math.inf, -math.inf]:
+        raise Exception("expected 0.0 and -0.0 to stay apart, got %r" % folded)
+
+    calls = []
+
+    def counting_sub(a, b):
+        calls.append((a, b))
+        return a - b
+
+    env = {OpSub: counting_sub, "a": 12, "b": 4}
+    fn = uel_compile("(a - b) > 5 and (a - b) < 10 or a - b == 2", env)
+    if fn(env) is not True or len(calls) != 1:
+        raise Exception("expected a - b to be computed once, got %r" % calls)
+    del calls[:]
+    selection, filter = uel_parse("a - b"), uel_parse("(a - b) * 2 > 3")
+    if compile_all([selection, filter], env)(env) != [8, True] or len(calls) != 1:
+        raise Exception("expected a - b to be shared across expressions")
+    shared = optimize([selection, filter], env)
+    if shared[0] is not shared[1].lhs.lhs.expr:
+        raise Exception("expected identical subtrees to be the same node")
+
+    same = ("a * (b + 1)", "a*(b+1) # comment", "(a) * ((b + 1))")
+    if len(set(fingerprint(uel_parse(input)) for input in same)) != 1:
+        raise Exception("expected %r to share a fingerprint" % (same,))
+    different = ("a * (b + 1)", "a * b + 1", "a * (b + 1.0)", "a * (b + true)")
+    if len(set(fingerprint(uel_parse(input)) for input in different)) != 4:
+        raise Exception("expected %r to have different fingerprints" % (different,))
+
+    affine = {"f": ("c", 9 / 5, 32), "g": ("c", -2, 0)}
+    for input, expected in (
+        ("f > 95", "c > 35.0"),
+        ("-4 >= f", "c <= -20.0"),
+        ("(f) < 50 and g < 10", "c < 10.0 and c > -5.0"),
+        ("f * 2", "c * 1.8 + 32 * 2"),
+        ("f > f", "c * 1.8 + 32 > c * 1.8 + 32"),
+    ):
+        folded = optimize([uel_parse(input)], {}, affine)[0]
+        if repr(folded) != expected:
+            raise Exception(
+                "input %r folded to %r, expected %r" % (input, folded, expected)
+            )
+
+    symbols = {
+        "x": Symbol(NUMBER),
+        "y": Symbol(NUMBER),
+        "flag": Symbol(BOOLEAN),
+    }
+
+    def check_kind(input, expected):
+        kind = check(uel_parse(input), symbols)
+        if kind != expected:
+            raise Exception(
+                "input %r checked as %r, expected %r" % (input, kind, expected)
+            )
+
+    def check_type_error(input, expected, message):
+        try:
+            check(uel_parse(input), symbols, expected)
+        except TypeCheckError as e:
+            if str(e) != message:
+                raise Exception(
+                    "input %r: expected %r, got %r" % (input, message, str(e))
+                )
+        else:
+            raise Exception("input %r: expected a type error" % input)
+
+    check_kind("x * 9 / 5 + -y ^ 2", NUMBER)
+    check_kind("(x > 1 and y <= 2) or not flag", BOOLEAN)
+    check_kind("flag == (x != y)", BOOLEAN)
+    check_type_error(
+        "x and y > 1",
+        None,
+        "Type error: 'and' needs true/false values, but x is a number",
+    )
+    check_type_error(
+        "-flag", None, "Type error: '-' needs number values, but flag is a true/false"
+    )
+    check_type_error(
+        "x == flag", None, "Type error: x == flag compares a number with a true/false"
+    )
+    check_type_error(
+        "x + 1", BOOLEAN, "Type error: expected a true/false expression, got a number"
+    )
+    try:
+        check(uel_parse("x + z"), symbols)
+    except UnboundVariableError:
+        pass
+    else:
+        raise Exception("expected unbound variable error")
+
+    cache = ParseCache(maxsize=2)
+    first = cache.get("a", lambda: uel_parse("1 + 2"))
+    if cache.get("a", lambda: None) is not first:
+        raise Exception("parse cache did not return the cached tree")
+    cache.get("b", lambda: uel_parse("3"))
+    cache.get("c", lambda: uel_parse("4"))
+    if "a" in cache.entries or cache.stats() != {
+        "hits": 1,
+        "misses": 3,
+        "size": 2,
+        "maxsize": 2,
+    }:
+        raise Exception("unexpected parse cache state %r" % cache.stats())
+    for _ in range(2):
+        try:
+            cache.get("d", lambda: uel_parse("1 +"))
+        except ParserError:
+            pass
+        else:
+            raise Exception("expected cached parser error")
+    if cache.stats()["misses"] != 4:
+        raise Exception("parser error was not cached")
+
+    try:
+        first.lhs = Value(3)
+    except AttributeError:
+        pass
+    else:
+        raise Exception("expected parsed nodes to be immutable")
+
+
+def run_benchmarks():
+    import timeit
+
+    def bench(name, expression, env, number):
+        tree = uel_parse(expression)
+        fn = compile(tree, env)
+        interpreted = min(timeit.repeat(lambda: tree.run(env), number=number))
+        compiled = min(timeit.repeat(lambda: fn(env), number=number))
+        print(
+            "%-24s interpreted %8.1f us  compiled %8.1f us  (%.1fx)"
+            % (
+                name,
+                interpreted / number * 1e6,
+                compiled / number * 1e6,
+                interpreted / compiled,
+            )
+        )
+
+    pasted = " and ".join(
+        "(tmax_avg_max_2050 - tmax_avg_max_2010) * %d.5 > %d # note %d\n" % (i, i, i)
+        for i in range(120)
+    )
+    parse_time = min(timeit.repeat(lambda: Parser(pasted).parse(), number=20)) / 20
+    print("parse %d bytes           %8.1f us" % (len(pasted), parse_time * 1e6))
+
+    env = {"x": 1.5, "y": 2.5}
+    bench("chain of 200", " + ".join(["x * y"] * 100), env, 2000)
+    nested = "x"
+    for _ in range(40):
+        nested = "(%s - y)" % nested
+    bench("40 nested parens", nested, env, 5000)
+    bench(
+        "mixed depth 8",
+        "not ((x + 1) * (y - 2) / (x ^ 2) > (y + 1) * 3 and x < y or y >= 1)",
+        env,
+        20000,
+    )
+
 
 def uel_eval(expression, env):
-    return Parser(expression).parse().run(env)
+    return uel_compile(expression, env)(env)
 
 
 def uel_parse(expression):
-    return Parser(expression).parse()
+    if hasattr(expression, "read"):
+        expression = expression.read()
+    return PARSE_CACHE.get(("uel", expression), lambda: Parser(expression).parse())
+
+
+def uel_compile(expression, env):
+    return compile(uel_parse(expression), env)
 
 
 if __name__ == "__main__":
-    run_tests()
+    import sys
+
+    if sys.argv[1:] == ["bench"]:
+        run_benchmarks()
+    else:
+        run_tests()
@@ -0,0 +1,686 @@
+#!/usr/bin/env python3
+
+"""
+numpy evaluation strategies for uel expressions over columns of data, where
+every variable in the env is an equal-length array (or pandas Series).
+"""
+
+import numpy as np
+
+import uel
+
+
+def power(base, exponent, out=None):
+    """
+    base ** exponent, written into out. uel's default ^ is python's **,
+    which numpy turns into cheaper ufuncs for some exponents (np.square for
+    2, depending on the numpy version) that can round differently from
+    np.power, so this goes through ** too, to agree with compiled
+    expressions to the last bit.
+    """
+    val = np.asarray(base) ** exponent
+    if out is None:
+        return val
+    np.copyto(out, val)
+    return out
+
+
+UFUNCS = {
+    uel.OpOr: np.logical_or,
+    uel.OpAnd: np.logical_and,
+    uel.OpAdd: np.add,
+    uel.OpSub: np.subtract,
+    uel.OpMul: np.multiply,
+    uel.OpDiv: np.true_divide,
+    uel.OpLess: np.less,
+    uel.OpLessEqual: np.less_equal,
+    uel.OpEqual: np.equal,
+    uel.OpNotEqual: np.not_equal,
+    uel.OpGreater: np.greater,
+    uel.OpGreaterEqual: np.greater_equal,
+    uel.OpExp: power,
+    uel.ModNot: np.logical_not,
+    uel.ModNeg: np.negative,
+}
+
+BLOCK_SIZE = 16384
+
+# filter_rows only starts from an index if the indexed comparison keeps at
+# most this fraction of the rows. past that, building the row set from the
+# index costs more than comparing the whole column. see run_benchmarks.
+INDEX_CROSSOVER = 0.1
+
+FLIPPED_COMPARISONS = uel.FLIPPED_COMPARISONS
+
+
+class Cancelled(Exception):
+    """
+    raised when an evaluation's cancelled callback says it's no longer
+    wanted.
+    """
+
+
+class BlockProgram:
+    """
+    a set of expressions compiled into a flat list of ufunc calls that run
+    over fixed-size row blocks. intermediate values live in block-sized
+    scratch buffers that are reused from block to block, and a buffer is
+    handed to the next step as soon as its last reader is done with it, so
+    temporary memory depends on the block size and the expression's width,
+    never on the number of rows. each expression's value is written into
+    one preallocated output array.
+
+    operands are ("const", value), ("col", name), ("buf", index) or
+    ("out", index) tuples.
+    """
+
+    def __init__(self, exprs, env, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.columns = {}
+        self.length = None
+        self.steps = []
+        self.buf_dtypes = []
+        self.out_dtypes = []
+
+        exprs = [expr and uel.unwrap(expr) for expr in uel.optimize(exprs, env)]
+        roots = set(id(expr) for expr in exprs if expr is not None)
+        uses = {}
+        stack = [expr for expr in exprs if expr is not None]
+        while stack:
+            node = uel.unwrap(stack.pop())
+            uses[id(node)] = uses.get(id(node), 0) + 1
+            if uses[id(node)] == 1:
+                stack.extend(node.children())
+
+        free_bufs = {}
+        operands = {}
+        stack = [(expr, False) for expr in exprs if expr is not None]
+        while stack:
+            node, ready = stack.pop()
+            node = uel.unwrap(node)
+            if id(node) in operands:
+                continue
+            children = [uel.unwrap(child) for child in node.children()]
+            if not ready:
+                stack.append((node, True))
+                stack.extend((child, False) for child in children)
+                continue
+            if isinstance(node, uel.Value):
+                operands[id(node)] = ("const", node.val)
+                continue
+            if isinstance(node, uel.Ident):
+                operands[id(node)] = self.bind(node.name, env)
+                continue
+
+            args = [operands[id(child)] for child in children]
+            ufunc = env.get(type(node))
+            if not isinstance(ufunc, np.ufunc):
+                ufunc = UFUNCS[type(node)]
+            with np.errstate(all="ignore"):
+                if all(arg[0] == "const" for arg in args):
+                    operands[id(node)] = ("const", ufunc(*[arg[1] for arg in args]))
+                    continue
+                dtype = ufunc(*[self.probe(arg) for arg in args]).dtype
+
+            for child in children:
+                uses[id(child)] -= 1
+                child_operand = operands[id(child)]
+                if uses[id(child)] == 0 and child_operand[0] == "buf":
+                    free_bufs.setdefault(self.buf_dtypes[child_operand[1]], []).append(
+                        child_operand[1]
+                    )
+
+            if id(node) in roots:
+                dest = ("out", len(self.out_dtypes))
+                self.out_dtypes.append(dtype)
+            elif free_bufs.get(dtype):
+                dest = ("buf", free_bufs[dtype].pop())
+            else:
+                dest = ("buf", len(self.buf_dtypes))
+                self.buf_dtypes.append(dtype)
+            operands[id(node)] = dest
+            self.steps.append((ufunc, args, dest))
+
+        self.results = [expr and operands[id(expr)] for expr in exprs]
+
+    def bind(self, name, env):
+        if name not in env:
+            raise uel.UnboundVariableError("%r" % name)
+        val = env[name]
+        if np.ndim(val) == 0:
+            return ("const", val)
+        if name not in self.columns:
+            col = np.asarray(val)
+            if self.length is None:
+                self.length = len(col)
+            elif len(col) != self.length:
+                raise ValueError(
+                    "column %r has %d rows, expected %d" % (name, len(col), self.length)
+                )
+            self.columns[name] = col
+        return ("col", name)
+
+    def probe(self, operand):
+        kind, val = operand
+        if kind == "const":
+            return val
+        if kind == "col":
+            return np.ones(1, self.columns[val].dtype)
+        if kind == "buf":
+            return np.ones(1, self.buf_dtypes[val])
+        return np.ones(1, self.out_dtypes[val])
+
+    def run(self, cancelled=None):
+        """
+        returns one value per expression: an array with one entry per row,
+        or a plain value if the expression didn't reference any columns.
+        cancelled, if given, is called before each block, and if it returns
+        true, run raises Cancelled instead of going on.
+        """
+        length = self.length or 0
+        outs = [np.empty(length, dtype) for dtype in self.out_dtypes]
+        block_size = min(self.block_size, length) or 1
+        bufs = [np.empty(block_size, dtype) for dtype in self.buf_dtypes]
+        columns = self.columns
+
+        def fetch(operand, start, stop):
+            kind, val = operand
+            if kind == "const":
+                return val
+            if kind == "col":
+                return columns[val][start:stop]
+            if kind == "buf":
+                return bufs[val][: stop - start]
+            return outs[val][start:stop]
+
+        with np.errstate(all="ignore"):
+            for start in range(0, length, block_size):
+                if cancelled is not None and cancelled():
+                    raise Cancelled()
+                stop = min(start + block_size, length)
+                for ufunc, args, dest in self.steps:
+                    ufunc(
+                        *[fetch(arg, start, stop) for arg in args],
+                        out=fetch(dest, start, stop)
+                    )
+
+        results = []
+        for operand in self.results:
+            if operand is None:
+                results.append(None)
+            elif operand[0] == "out":
+                results.append(outs[operand[1]])
+            elif operand[0] == "col":
+                results.append(columns[operand[1]])
+            elif self.length is not None:
+                results.append(np.full(self.length, operand[1]))
+            else:
+                results.append(operand[1])
+        return results
+
+
+def evaluate_blockwise(exprs, env, block_size=BLOCK_SIZE, cancelled=None):
+    """
+    evaluates parsed expressions over env the same way uel.compile_all
+    would, but a block of rows at a time. see BlockProgram.
+    """
+    return BlockProgram(exprs, env, block_size).run(cancelled)
+
+
+def conjuncts(expr):
+    """
+    splits a chain of ands into its parts, in source order.
+    """
+    parts = []
+    stack = [expr]
+    while stack:
+        node = uel.unwrap(stack.pop())
+        if isinstance(node, uel.OpAnd):
+            stack.append(node.rhs)
+            stack.append(node.lhs)
+        else:
+            parts.append(node)
+    return parts
+
+
+def shares_subtrees(exprs):
+    """
+    returns whether any subtree other than a variable or a constant appears
+    in more than one of exprs. they should have been through uel.optimize
+    together, so identical subtrees are the very same node.
+    """
+    owners = {}
+    for owner, expr in enumerate(exprs):
+        stack = [expr] if expr is not None else []
+        while stack:
+            node = uel.unwrap(stack.pop())
+            children = node.children()
+            if not children or owners.get(id(node)) == owner:
+                continue
+            if owners.setdefault(id(node), owner) != owner:
+                return True
+            stack.extend(children)
+    return False
+
+
+def narrow(env, expr, rows):
+    """
+    returns an env with just the operators from env and the variables expr
+    uses, with columns cut down to rows (an index array, or None for all).
+    """
+    sub_env = {cls: env[cls] for cls in UFUNCS if cls in env}
+    for name in uel.identifiers(expr):
+        if name not in env:
+            raise uel.UnboundVariableError("%r" % name)
+        val = env[name]
+        if rows is not None and np.ndim(val) != 0:
+            val = np.asarray(val)[rows]
+        sub_env[name] = val
+    return sub_env
+
+
+def column_length(expr, env):
+    for name in uel.identifiers(expr):
+        if name in env and np.ndim(env[name]) != 0:
+            return len(env[name])
+    return None
+
+
+def sample_selectivity(part, env, length, sample_size=1024):
+    """
+    estimates the fraction of rows part keeps by evaluating it on an evenly
+    spaced sample of rows.
+    """
+    rows = np.arange(0, length, max(1, length // sample_size))
+    with np.errstate(all="ignore"):
+        keep = uel.compile(part, env)(narrow(env, part, rows))
+    return np.broadcast_to(np.asarray(keep, dtype=bool), rows.shape).mean()
+
+
+class SortedIndex:
+    """
+    a column's values in sorted order, so a comparison against a constant
+    turns into a pair of binary searches. a comparison's answer is a list
+    of (lo, hi) ranges of positions in sorted order. rank maps each row
+    back to its position, so whether given rows fall in those ranges can
+    be checked without touching the column. NaNs sort last, and only !=
+    ever matches them.
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        self.order = np.argsort(values, kind="stable")
+        self.sorted = values[self.order]
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(values))
+        self.valid = len(values)
+        if values.dtype.kind == "f":
+            self.valid -= np.count_nonzero(np.isnan(values))
+
+    @property
+    def nbytes(self):
+        return self.order.nbytes + self.sorted.nbytes + self.rank.nbytes
+
+    def ranges(self, cls, value):
+        total = len(self.order)
+        if value != value:
+            return [(0, total)] if cls is uel.OpNotEqual else []
+        if self.sorted.dtype.kind == "f":
+            # compare at the column's precision, like the ufuncs would
+            value = self.sorted.dtype.type(value)
+        valid = self.sorted[: self.valid]
+        left = int(np.searchsorted(valid, value, "left"))
+        right = int(np.searchsorted(valid, value, "right"))
+        if cls is uel.OpLess:
+            return [(0, left)]
+        if cls is uel.OpLessEqual:
+            return [(0, right)]
+        if cls is uel.OpGreater:
+            return [(right, self.valid)]
+        if cls is uel.OpGreaterEqual:
+            return [(left, self.valid)]
+        if cls is uel.OpEqual:
+            return [(left, right)]
+        return [(0, left), (right, total)]
+
+    def count(self, ranges):
+        return sum(hi - lo for lo, hi in ranges)
+
+    def rows(self, ranges):
+        if not ranges:
+            return np.empty(0, dtype=self.order.dtype)
+        return np.sort(np.concatenate([self.order[lo:hi] for lo, hi in ranges]))
+
+    def contains(self, rows, ranges):
+        positions = self.rank[rows]
+        keep = np.zeros(len(rows), dtype=bool)
+        for lo, hi in ranges:
+            keep |= (positions >= lo) & (positions < hi)
+        return keep
+
+
+def constant_value(expr):
+    expr = uel.unwrap(expr)
+    if isinstance(expr, uel.Value):
+        return True, expr.val
+    if isinstance(expr, uel.ModNeg) and isinstance(uel.unwrap(expr.val), uel.Value):
+        return True, -uel.unwrap(expr.val).val
+    return False, None
+
+
+def constant_comparison(part):
+    """
+    if part compares a variable with a constant, returns (cls, name, value)
+    with the variable on the left, otherwise None.
+    """
+    part = uel.unwrap(part)
+    if type(part) not in FLIPPED_COMPARISONS:
+        return None
+    cls, lhs, rhs = type(part), uel.unwrap(part.lhs), part.rhs
+    if not isinstance(lhs, uel.Ident):
+        cls, lhs, rhs = FLIPPED_COMPARISONS[cls], uel.unwrap(part.rhs), part.lhs
+    if not isinstance(lhs, uel.Ident):
+        return None
+    is_constant, value = constant_value(rhs)
+    if not is_constant:
+        return None
+    return cls, lhs.name, value
+
+
+def index_lookup(part, indexes):
+    """
+    if part is a comparison between an indexed variable and a constant,
+    returns (index, ranges) for it, otherwise None.
+    """
+    comparison = indexes and constant_comparison(part)
+    if not comparison or comparison[1] not in indexes:
+        return None
+    cls, name, value = comparison
+    index = indexes[name]
+    return index, index.ranges(cls, value)
+
+
+def stats_selectivity(stats, fallback=sample_selectivity):
+    """
+    returns an estimate for filter_rows that answers comparisons between a
+    variable and a constant from stats, a dict of variable name to
+    datastats.ColumnStats, and leaves everything else to fallback.
+    """
+
+    def estimate(part, env, length):
+        comparison = constant_comparison(part)
+        if comparison is None or comparison[1] not in stats:
+            return fallback(part, env, length)
+        cls, name, value = comparison
+        return stats[name].fraction(cls, value)
+
+    return estimate
+
+
+def filter_rows(
+    expr,
+    env,
+    estimate=None,
+    indexes=None,
+    crossover=INDEX_CROSSOVER,
+    cancelled=None,
+):
+    """
+    returns the sorted indexes of the rows where the filter expr holds. the
+    parts of a chain of ands are evaluated most selective first, each one only
+    over the rows every earlier part kept, so later parts get cheaper. the
+    result is exactly the rows np.logical_and over every part would keep.
+
+    indexes optionally maps variable names to SortedIndexes over the same
+    values as env. parts that compare one of those against a constant are
+    answered from the index: the most selective one seeds the row set if it
+    keeps at most the crossover fraction of rows, and the others check rows
+    by rank.
+
+    estimate(part, env, length) should return the fraction of rows part is
+    expected to keep, and defaults to sample_selectivity. indexed parts
+    don't need estimating, since the index knows exactly.
+
+    if the parts have subtrees in common, narrowing part by part would
+    compute those once per part, so the parts are evaluated together
+    instead, with one uel.compile_all over the rows the index left.
+
+    cancelled, if given, is called before each part is evaluated, and if it
+    returns true, filter_rows raises Cancelled.
+    """
+    length = column_length(expr, env)
+    if length is None:
+        raise ValueError("filter %r doesn't refer to any columns" % expr)
+    if estimate is None:
+        estimate = sample_selectivity
+    parts = [(part, index_lookup(part, indexes)) for part in conjuncts(expr)]
+
+    rows = None
+    indexed = [lookup for _, lookup in parts if lookup is not None]
+    if indexed:
+        index, ranges = min(indexed, key=lambda lookup: lookup[0].count(lookup[1]))
+        if index.count(ranges) <= crossover * length:
+            rows = index.rows(ranges)
+
+    if shares_subtrees([part for part, _ in parts]):
+        if cancelled is not None and cancelled():
+            raise Cancelled()
+        size = length if rows is None else len(rows)
+        keep = np.ones(size, dtype=bool)
+        with np.errstate(all="ignore"):
+            run_all = uel.compile_all([part for part, _ in parts], env)
+            for val in run_all(narrow(env, expr, rows)):
+                keep &= np.broadcast_to(np.asarray(val, dtype=bool), (size,))
+        return np.flatnonzero(keep) if rows is None else rows[keep]
+
+    if len(parts) > 1:
+        order = []
+        for part, lookup in parts:
+            if lookup is not None:
+                order.append(lookup[0].count(lookup[1]) / float(length))
+            else:
+                order.append(estimate(part, env, length))
+        parts = [item for _, _, item in sorted(zip(order, range(len(parts)), parts))]
+
+    with np.errstate(all="ignore"):
+        for part, lookup in parts:
+            if rows is not None and len(rows) == 0:
+                break
+            if cancelled is not None and cancelled():
+                raise Cancelled()
+            if lookup is not None and rows is not None:
+                rows = rows[lookup[0].contains(rows, lookup[1])]
+                continue
+            keep = uel.compile(part, env)(narrow(env, part, rows))
+            size = length if rows is None else len(rows)
+            keep = np.broadcast_to(np.asarray(keep, dtype=bool), (size,))
+            rows = np.flatnonzero(keep) if rows is None else rows[keep]
+    return rows
+
+
+def filter_mask(expr, env, estimate=None, indexes=None):
+    """
+    like filter_rows, but returns a boolean mask over all rows.
+    """
+    rows = filter_rows(expr, env, estimate, indexes)
+    mask = np.zeros(column_length(expr, env), dtype=bool)
+    mask[rows] = True
+    return mask
+
+
+def run_tests():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=1000)
+    a[::17] = np.nan
+    env = {
+        uel.OpOr: np.logical_or,
+        uel.OpAnd: np.logical_and,
+        uel.ModNot: np.logical_not,
+        "a": a,
+        "b": rng.normal(size=1000),
+        "n": rng.integers(1, 10, size=1000),
+        "true": True,
+    }
+
+    def check(*expressions):
+        exprs = [uel.uel_parse(expression) for expression in expressions]
+        expected = uel.compile_all(exprs, env)(env)
+        for block_size in (7, 1000, 4096):
+            got = evaluate_blockwise(exprs, env, block_size)
+            for expression, want, val in zip(expressions, expected, got):
+                want = np.broadcast_to(want, val.shape)
+                if val.dtype != want.dtype or not np.array_equal(
+                    val, want, equal_nan=val.dtype.kind == "f"
+                ):
+                    raise Exception(
+                        "blockwise %r with block size %d differs"
+                        % (expression, block_size)
+                    )
+
+    check("a")
+    check("a + b * 2 - a / b ^ 2")
+    check("-a * 9 / 5 + 32 > 50 and not (b < 0 or n == 3)")
+    check("(a - b) * n", "(a - b) > 0.5 and true")
+    check("n / 2 + n ^ 2", "n != 4")
+    check("1 + 2", "a >= 0")
+
+    try:
+        evaluate_blockwise([uel.uel_parse("a + c")], env)
+    except uel.UnboundVariableError:
+        pass
+    else:
+        raise Exception("expected unbound variable error")
+
+    def check_filter(expression):
+        expected = uel.uel_compile(expression, env)(env)
+        expected = np.broadcast_to(np.asarray(expected, dtype=bool), a.shape)
+        for estimate in (None, lambda part, env, length: -len(repr(part))):
+            mask = filter_mask(uel.uel_parse(expression), env, estimate)
+            if not np.array_equal(mask, expected):
+                raise Exception("filter %r gave a different mask" % expression)
+
+    indexes = {"a": SortedIndex(a), "n": SortedIndex(env["n"])}
+    for cls in FLIPPED_COMPARISONS:
+        for value in (np.nan, -1e9, 0.25, a[3], 5, 1e9):
+            ranges = indexes["a"].ranges(cls, value)
+            expected = np.flatnonzero(UFUNCS[cls](a, value))
+            if not np.array_equal(indexes["a"].rows(ranges), expected):
+                raise Exception("index lookup of a %s %r is wrong" % (cls.op, value))
+            if not np.array_equal(
+                indexes["a"].contains(np.arange(len(a)), ranges),
+                UFUNCS[cls](a, value),
+            ):
+                raise Exception(
+                    "index membership of a %s %r is wrong" % (cls.op, value)
+                )
+
+    for expression in (
+        "a > 2 and n == 3",
+        "a < -1 and 0.5 < b and 4 >= n",
+        "n != 2 and a > -0.1 and a < 0.1",
+        "a > 0 and b > 0",
+        "-2 > a and n > 1 and a * b > 0.1",
+    ):
+        expected = np.asarray(uel.uel_compile(expression, env)(env), dtype=bool)
+        for crossover in (0.0, 0.05, 1.0):
+            rows = filter_rows(uel.uel_parse(expression), env, None, indexes, crossover)
+            mask = np.zeros(len(a), dtype=bool)
+            mask[rows] = True
+            if not np.array_equal(mask, expected):
+                raise Exception("indexed filter %r gave a different mask" % expression)
+
+    check_filter("a > 0")
+    check_filter("a > 0 and b < 0.5 and n != 3")
+    check_filter("(a > -1 and (b < 2 and n >= 2)) and a < b")
+    check_filter("a and true and n > 4")
+    check_filter("a > 5 and b > 5 and a < -5")
+    check_filter("not (a > 0) and (b > 1 or n == 2)")
+
+    # a - b is computed once, not once per part and once per sample
+    calls = []
+
+    def counting_sub(x, y):
+        calls.append((x, y))
+        return np.subtract(x, y)
+
+    sub_env = dict(env)
+    sub_env[uel.OpSub] = counting_sub
+    for expression in ("(a - b) > 0.5 and (a - b) < 2", "(a - b) > 0 and n > 2"):
+        expr = uel.optimize([uel.uel_parse(expression)], sub_env)[0]
+        del calls[:]
+        rows = filter_rows(expr, sub_env, None, indexes, 1.0)
+        expected = uel.uel_compile(expression, env)(env)
+        if not np.array_equal(rows, np.flatnonzero(expected)):
+            raise Exception("filter %r gave different rows" % expression)
+        if expression.count("a - b") == 2 and len(calls) != 1:
+            raise Exception("expected a - b to be computed once, got %d" % len(calls))
+    if shares_subtrees([uel.uel_parse("a + b"), uel.uel_parse("a > b")]):
+        raise Exception("expected only variables in common")
+
+    checks = []
+
+    def cancel_after_three():
+        checks.append(None)
+        return len(checks) > 3
+
+    try:
+        evaluate_blockwise([uel.uel_parse("a * b")], env, 100, cancel_after_three)
+    except Cancelled:
+        if len(checks) != 4:
+            raise Exception("expected a check before each block")
+    else:
+        raise Exception("expected evaluation to be cancelled")
+
+    # a chain of ten operators shouldn't need ten scratch buffers
+    program = BlockProgram([uel.uel_parse(" + ".join(["a * b"] * 10))], env)
+    if len(program.buf_dtypes) > 3:
+        raise Exception("expected scratch buffers to be reused")
+
+
+def run_benchmarks():
+    import time, tracemalloc
+
+    rows = 4000000
+    rng = np.random.default_rng(0)
+    env = {"a": rng.normal(size=rows), "b": rng.normal(size=rows)}
+    exprs = [uel.uel_parse("((a - b) * 9 / 5 + 32) ^ 2 / (a * a + b * b + 1) - a + b")]
+
+    def measure(name, fn):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-10s %7.1f ms  peak %7.1f MB" % (name, elapsed * 1e3, peak / 1e6))
+
+    measure("vector", lambda: uel.compile_all(exprs, env)(env))
+    measure("blockwise", lambda: evaluate_blockwise(exprs, env))
+
+    env.update({uel.OpAnd: np.logical_and, "c": rng.normal(size=rows)})
+    filter = uel.uel_parse("a * b > 0 and c ^ 2 < 4 and a > 2 and b - c > 0")
+    measure("and chain", lambda: uel.compile(filter, env)(env))
+    measure("narrowing", lambda: filter_rows(filter, env))
+
+    # where starting from an index stops paying off against a full scan
+    indexes = {"a": SortedIndex(env["a"])}
+    print("selectivity   scan ms  index ms")
+    for selectivity in (0.0001, 0.001, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5):
+        threshold = np.quantile(env["a"], selectivity)
+        part = uel.OpLess(uel.Ident("a"), uel.Value(float(threshold)))
+        timings = []
+        for part_indexes in (None, indexes):
+            start = time.perf_counter()
+            for _ in range(5):
+                filter_rows(part, env, indexes=part_indexes, crossover=1.0)
+            timings.append((time.perf_counter() - start) / 5 * 1e3)
+        print("%11.4f %9.2f %9.2f" % (selectivity, timings[0], timings[1]))
+
+
+if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["bench"]:
+        run_benchmarks()
+    else:
+        run_tests()